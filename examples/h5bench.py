@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+import time
+
+from h5image import H5Image
+
+# usage: python h5bench.py [folder] [map]
+folder = sys.argv[1] if len(sys.argv) > 1 else "./data"
+filename = sys.argv[2] if len(sys.argv) > 2 else "CA_Sage"
+patch_size = 256
+patch_border = 3
+samples = 500
+
+# (name, arguments passed to H5Image)
+strategies = [
+    ("patch", dict(chunks="patch")),
+    ("patch+packed", dict(chunks="patch", pack_masks=True)),
+    ("tile", dict(chunks="tile")),
+    ("auto", dict(chunks="auto")),
+    ("1024", dict(chunks=(1024, 1024))),
+    ("contiguous", dict(chunks=None, compression=None)),
+    ("memmap", dict(chunks=None, compression=None)),
+    ("gzip", dict(compression="gzip")),
+    ("blosc-lz4", dict(compression="blosc-lz4")),
+    ("zstd", dict(compression="zstd")),
+    ("codec-auto", dict(compression="auto")),
+]
+
+# extra arguments passed to H5Image when reading
+read_args = {
+    "memmap": dict(memmap=True),
+}
+
+
+######################################################################
+## CREATE FILES
+######################################################################
+def create(name, kwargs):
+    h5file = f"bench/{filename}_{name}.hdf5"
+    os.makedirs(os.path.dirname(h5file), exist_ok=True)
+    if os.path.exists(h5file):
+        os.unlink(h5file)
+    h5i = H5Image(h5file, "w", patch_size=patch_size, patch_border=patch_border, **kwargs)
+    t = time.time()
+    h5i.add_image(f"{filename}.json", folder=folder)
+    h5i.close()
+    return h5file, time.time() - t
+
+
+######################################################################
+## RANDOM PATCHES
+######################################################################
+def bench(h5file, kwargs):
+    h5i = H5Image(h5file, "r", patch_size=patch_size, patch_border=patch_border, **kwargs)
+    patches = h5i.get_patches(filename, by_location=True)
+    rng = random.Random(42)
+    locations = [rng.choice(list(patches.items())) for _ in range(samples)]
+    map_time = layer_time = 0
+    for loc, layers in locations:
+        row, col = [int(x) for x in loc.split("_")]
+        t = time.time()
+        h5i.get_patch(row, col, filename)
+        map_time += time.time() - t
+        t = time.time()
+        h5i.get_patch(row, col, filename, rng.choice(layers))
+        layer_time += time.time() - t
+    layer_bytes = sum(h5i.h5f[filename][layer].id.get_storage_size() for layer in h5i.get_layers(filename))
+    h5i.close()
+    return map_time / samples, layer_time / samples, layer_bytes
+
+
+print(f"{'strategy':12s} {'size (MB)':>10s} {'layers (MB)':>11s} {'create (s)':>10s} {'map (ms)':>9s} {'layer (ms)':>10s}")
+for name, kwargs in strategies:
+    h5file, create_time = create(name, kwargs)
+    map_latency, layer_latency, layer_bytes = bench(h5file, read_args.get(name, {}))
+    print(f"{name:12s} {os.path.getsize(h5file) / 2**20:10.1f} {layer_bytes / 2**20:11.2f} {create_time:10.2f} "
+          f"{map_latency * 1000:9.3f} {layer_latency * 1000:10.3f}")
@@ -1,8 +1,7 @@
-import glob
 import concurrent.futures
+import sys
 
-from h5image import H5Image
-import os
+from h5image import H5Folder, PatchLoader
 import time
 import random
 import math
@@ -18,17 +17,15 @@ jobspatch = 30
 ## OPEN FOLDER
 ######################################################################
 def setup():
-    mapsh5i = {}
-    for file in glob.glob("/projects/bbym/shared/data/commonPatchData/256/*.hdf5"):
-        mapname = os.path.basename(file).replace(".hdf5", "")
-        mapsh5i[mapname] = H5Image(file, "r")
-    return mapsh5i
+    return H5Folder("/projects/bbym/shared/data/commonPatchData/256", max_open_files=64)
 
 
 def main():
     t = time.time()
+    # the folder is pickled as its configuration, each worker opens the files it uses
+    h5f = setup()
     with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
-        jobs = [executor.submit(compute, jobspatch) for x in range(numjobs)]
+        jobs = [executor.submit(compute, h5f, jobspatch) for x in range(numjobs)]
         for job in concurrent.futures.as_completed(jobs):
             data = job.result()
             #print(len(data))
@@ -36,31 +33,45 @@ def main():
     print("loop", time.time()-t)
 
 
+def main_loader():
+    # the workers write the patches into shared memory, only slot numbers are sent back
+    t = time.time()
+    loader = PatchLoader(setup(), workers=workers, slots=64, samples=numjobs * jobspatch)
+    for sample in loader:
+        rgb_map, rgb_layer = sample["map"], sample["layer"]
+    loader.close()
+    print("loader", time.time()-t)
+
+
 ######################################################################
 ## PARALEL CODE
 ######################################################################
-def compute(count):
-    mapsh5i = setup()
-    maps = list(mapsh5i.keys())
+def compute(h5f, count):
+    maps = h5f.get_maps()
     result = []
     for i in range(count):
         map = random.choice(maps)
-        bounds = mapsh5i[map].get_map_size(map)
-        patches = mapsh5i[map].get_patches(map, by_location=True)
+        bounds = h5f.get_map_size(map)
+        patches = h5f.get_patches(map, by_location=True)
         patch = random.choice(list(patches.keys()))
         row = int(patch.split("_")[0])
         col = int(patch.split("_")[1])
         layer = random.choice(patches.get(patch))
-        rgb_map = mapsh5i[map].get_patch(row, col, map)
-        rgb_layer = mapsh5i[map].get_patch(row, col, map, layer)
+        rgb_map = h5f.get_patch(row, col, map)
+        rgb_layer = h5f.get_patch(row, col, map, layer)
         try:
-            rgb_legend = mapsh5i[map].get_legend(map, layer)
+            rgb_legend = h5f.get_legend(map, layer)
         except:
             rgb_legend = []
             print(f"Error loading legend {layer} for {map}")
         result.append({ "map": rgb_map, "layer": rgb_layer, "legend": rgb_legend, "mapname": map, "layername": layer })
+    h5f.close()
     return result
 
 
 if __name__ == "__main__":
-    main()
+    # usage: python h5many.py [loader]
+    if len(sys.argv) > 1 and sys.argv[1] == "loader":
+        main_loader()
+    else:
+        main()
@@ -31,7 +31,8 @@ if not os.path.exists(f"hdf/{patch_size}/{patch_border}/{filename}.hdf5"):
     print("create", time.time()-t)
 else:
     t = time.time()
-    h5i = H5Image(f"hdf/{patch_size}/{patch_border}/{filename}.hdf5", "r", patch_size=300, patch_border=99)
+    h5i = H5Image(f"hdf/{patch_size}/{patch_border}/{filename}.hdf5", "r", patch_size=300, patch_border=99,
+                  cache_bytes=256 * 2**20)
     print("open", time.time()-t)
 
 ######################################################################
@@ -200,3 +201,4 @@ with ThreadPoolExecutor(max_workers=16) as executor:
     future = executor.submit(compute, 16)
     future.result()
 print("loop", time.time()-t)
+print("cache", h5i.get_cache_stats())
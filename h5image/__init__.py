@@ -1,2 +1,9 @@
 from .h5image import H5Image
+from .h5folder import H5Folder
+from .h5sampler import PatchSampler
+from .h5loader import PatchLoader
+from .h5async import AsyncH5Image
+from .h5spatial import SpatialIndex
 from .h5create import *
+from .h5catalog import *
+from .h5serve import *
@@ -0,0 +1,227 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import numpy as np
+
+from .h5folder import H5Folder
+from .h5image import H5Image
+
+
+class AsyncH5Image:
+    """Asyncio interface to read patches and metadata of a HDF5 file or folder"""
+
+    def __init__(self, source, workers=4, serialize=True, **kwargs):
+        """
+        Create a new AsyncH5Image. All reads run in a pool of at most workers threads, so the
+        event loop is never blocked by reading or decompressing data. If serialize is set, only
+        one read of each HDF5 file runs at a time, and the other threads read other files. Reads
+        of the same data that are requested while the read is running are coalesced, one read
+        is done and all requests get the same result, so the numpy arrays returned can be shared
+        and should not be modified.
+        :param source: H5Image or H5Folder, or the filename of a HDF5 file that is opened read-only
+        :param workers: number of threads used to read
+        :param serialize: only run one read at a time for each HDF5 file
+        :param kwargs: extra arguments passed to H5Image when source is a filename
+        """
+        if isinstance(source, str):
+            source = H5Image(source, "r", **kwargs)
+        self.source = source
+        self.workers = workers
+        self.serialize = serialize
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._inflight = {}
+        self._calls = 0
+        self._coalesced = 0
+
+    def __str__(self):
+        """
+        String representation of the object
+        :return: string representation
+        """
+        return f"AsyncH5Image(source={self.source}, workers={self.workers}, #inflight={len(self._inflight)})"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Wait for the running reads, stop the threads and close the file or folder.
+        """
+        self._executor.shutdown()
+        self.source.close()
+
+    def _get_lock(self, mapname):
+        """
+        Helper function to get the lock of the HDF5 file with the map.
+        :param mapname: the name of the map, None for the file of a H5Image
+        :return: lock of the file, None if reads are not serialized
+        """
+        if not self.serialize:
+            return None
+        if isinstance(self.source, H5Folder):
+            if mapname is None:
+                return None
+            filename = self.source.get_filename(mapname)
+        else:
+            filename = self.source.h5file
+        with self._locks_lock:
+            lock = self._locks.get(filename)
+            if lock is None:
+                lock = self._locks[filename] = threading.Lock()
+            return lock
+
+    def _call(self, mapname, method, args):
+        """
+        Helper function to call a method of the source, running in a worker thread.
+        :param mapname: the name of the map, used to find the lock of the file
+        :param method: name of the method
+        :param args: arguments of the method
+        :return: result of the method
+        """
+        lock = self._get_lock(mapname)
+        if lock is None:
+            return getattr(self.source, method)(*args)
+        with lock:
+            return getattr(self.source, method)(*args)
+
+    async def _run(self, mapname, method, *args):
+        """
+        Helper function to run a method of the source in the thread pool. If the same call is
+        already running, the result of that call is used.
+        :param mapname: the name of the map, used to find the lock of the file
+        :param method: name of the method
+        :param args: arguments of the method, these need to be hashable
+        :return: result of the method
+        """
+        key = (method, args)
+        self._calls += 1
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, self._call, mapname, method, args)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self._coalesced += 1
+        # a cancelled request should not cancel the read for the other requests
+        return await asyncio.shield(future)
+
+    async def get_maps(self):
+        """
+        Returns a list of all maps.
+        :return: list of map names
+        """
+        return await self._run(None, 'get_maps')
+
+    async def get_map_size(self, mapname, level=0):
+        """
+        Returns the size of the map.
+        :param mapname: the name of the map
+        :param level: overview level, 0 for the full resolution
+        :return: size of the map
+        """
+        return await self._run(mapname, 'get_map_size', mapname, level)
+
+    async def get_layers(self, mapname):
+        """
+        Returns a list of all layers for a map.
+        :param mapname: the name of the map
+        :return: list of layer names
+        """
+        return await self._run(mapname, 'get_layers', mapname)
+
+    async def get_patches(self, mapname, by_location=False):
+        """
+        Returns the patches of a map, see H5Image.get_patches.
+        :param mapname: the name of the map
+        :param by_location: if True, return a dictionary with locations as keys and layers as values
+        :return: patches of the map
+        """
+        return await self._run(mapname, 'get_patches', mapname, by_location)
+
+    async def get_valid_patches(self, mapname):
+        """
+        Returns a list of all valid patches for a map.
+        :param mapname: the name of the map
+        :return: list of valid patches
+        """
+        return await self._run(mapname, 'get_valid_patches', mapname)
+
+    async def get_layers_for_patch(self, mapname, row, col):
+        """
+        Returns a list of all layers for a patch.
+        :param mapname: the name of the map
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :return: list of layers
+        """
+        return await self._run(mapname, 'get_layers_for_patch', mapname, row, col)
+
+    async def get_patch(self, row, col, mapname, layer="map", level=0):
+        """
+        Returns the cropped image of the patch.
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param level: overview level, 0 for the full resolution
+        :return: cropped image of patch as a numpy array
+        """
+        return await self._run(mapname, 'get_patch', row, col, mapname, layer, level)
+
+    async def get_legend(self, mapname, layer):
+        """
+        Returns the cropped image of the legend of the layer.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :return: cropped image of legend as a numpy array
+        """
+        return await self._run(mapname, 'get_legend', mapname, layer)
+
+    async def get_patches_batch(self, locations, mapname=None, layer="map"):
+        """
+        Returns the cropped images of many patches as a single numpy array, see
+        H5Image.get_patches_batch. For a folder the patches of each map are read in parallel.
+        :param locations: list of (row, col) or (mapname, layer, row, col)
+        :param mapname: the name of the map, used for (row, col) locations
+        :param layer: the name of the layer, used for (row, col) locations
+        :return: patches as a numpy array (N, patch_size, patch_size[, 3])
+        """
+        locations = tuple(tuple(int(v) if isinstance(v, np.integer) else v for v in location)
+                          for location in locations)
+        if not isinstance(self.source, H5Folder):
+            return await self._run(None, 'get_patches_batch', locations, mapname, layer)
+        if any(len(location) == 2 for location in locations):
+            if mapname is None:
+                raise ValueError("Need mapname for (row, col) locations")
+            locations = tuple((mapname, layer) + location if len(location) == 2 else location
+                              for location in locations)
+        maps = {}
+        for i, location in enumerate(locations):
+            maps.setdefault(location[0], []).append(i)
+        if not maps:
+            return await self._run(None, 'get_patches_batch', locations)
+        batches = await asyncio.gather(*[self._run(name, 'get_patches_batch', tuple(locations[i] for i in indices))
+                                         for name, indices in maps.items()])
+        out = np.zeros((len(locations),) + batches[0].shape[1:], dtype=np.uint8)
+        for indices, patches in zip(maps.values(), batches):
+            out[indices] = patches
+        return out
+
+    def get_stats(self):
+        """
+        Returns the number of requests, the number of requests that used the result of a running
+        read, and the number of reads running.
+        :return: dict with calls, coalesced and inflight
+        """
+        return {
+            'calls': self._calls,
+            'coalesced': self._coalesced,
+            'inflight': len(self._inflight),
+        }
@@ -0,0 +1,102 @@
+import collections
+import threading
+
+
+class PatchCache:
+    """Thread-safe LRU cache of decoded patches with a budget in bytes"""
+
+    def __init__(self, max_bytes):
+        """
+        Create a new PatchCache. Patches are stored as numpy arrays, when the total size of the
+        patches is more than max_bytes the least recently used patches are removed.
+        :param max_bytes: maximum number of bytes of all patches in the cache
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._patches = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        """
+        String representation of the object
+        :return: string representation
+        """
+        return f"PatchCache(max_bytes={self.max_bytes}, bytes={self.bytes}, #patches={len(self._patches)})"
+
+    def __contains__(self, key):
+        """
+        Check if a patch is in the cache, without changing the statistics or the order of the patches.
+        :param key: key of the patch, (mapname, layer, row, col, level)
+        :return: True if the patch is in the cache
+        """
+        with self._lock:
+            return key in self._patches
+
+    def get(self, key):
+        """
+        Returns a patch from the cache. The patch returned is shared and should not be modified.
+        :param key: key of the patch, (mapname, layer, row, col, level)
+        :return: patch as numpy array, None if the patch is not in the cache
+        """
+        with self._lock:
+            patch = self._patches.get(key)
+            if patch is None:
+                self.misses += 1
+                return None
+            self._patches.move_to_end(key)
+            self.hits += 1
+            return patch
+
+    def put(self, key, patch):
+        """
+        Add a patch to the cache, removing the least recently used patches if the cache is
+        too large. Patches larger than the cache are not stored.
+        :param key: key of the patch, (mapname, layer, row, col, level)
+        :param patch: patch as numpy array, this should not be modified after it is added
+        """
+        if patch.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._patches.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._patches[key] = patch
+            self.bytes += patch.nbytes
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._patches.popitem(last=False)[1].nbytes
+                self.evictions += 1
+
+    def invalidate(self, mapname):
+        """
+        Remove all patches of a map from the cache.
+        :param mapname: the name of the map
+        """
+        with self._lock:
+            for key in [key for key in self._patches if key[0] == mapname]:
+                self.bytes -= self._patches.pop(key).nbytes
+
+    def clear(self):
+        """
+        Remove all patches from the cache and reset the statistics.
+        """
+        with self._lock:
+            self._patches.clear()
+            self.bytes = self.hits = self.misses = self.evictions = 0
+
+    def get_stats(self):
+        """
+        Returns the statistics of the cache.
+        :return: dict with hits, misses, evictions, number of patches and bytes used
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'patches': len(self._patches),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
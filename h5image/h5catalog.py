@@ -0,0 +1,160 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import os.path
+import pathlib
+
+import h5py
+
+from .h5image import H5Image
+from .h5spatial import map_footprint
+
+CATALOG_FILE = "catalog.json"
+CATALOG_VERSION = 1
+
+
+def open_h5image(h5file):
+    """
+    Open a HDF5 file read-only using the patch size, border and compression stored in
+    the file, so no mismatch warnings are logged.
+    :param h5file: filename on disk
+    :return: H5Image object
+    """
+    with h5py.File(h5file, "r") as h5f:
+        attrs = h5f['/'].attrs
+        compression = attrs.get('compression', b'lzf').decode('utf-8')
+        if compression == 'none':
+            compression = None
+        elif compression.startswith('{'):
+            compression = json.loads(compression)
+        patch_size = int(attrs.get('patch_size', 256))
+        patch_border = int(attrs.get('patch_border', 3))
+    return H5Image(h5file, "r", compression=compression, patch_size=patch_size, patch_border=patch_border)
+
+
+def catalog_entries(h5file, folder):
+    """
+    Compute the catalog entries for all maps in a HDF5 file. Besides the number of patches of
+    each layer, the entries store the patches of each layer, so H5Folder and PatchSampler can
+    list the patches without opening the file.
+    :param h5file: filename on disk
+    :param folder: folder of the catalog, the filename is stored relative to this folder
+    :return: dict with for each map the catalog entry
+    """
+    stat = os.stat(h5file)
+    entries = {}
+    h5i = open_h5image(h5file)
+    try:
+        for mapname in h5i.get_maps():
+            patches = h5i.get_patches(mapname)
+            entries[mapname] = {
+                'file': os.path.relpath(h5file, folder),
+                'mtime': stat.st_mtime,
+                'filesize': stat.st_size,
+                'shape': list(h5i.get_map_size(mapname)),
+                'patch_size': h5i.patch_size,
+                'patch_border': h5i.patch_border,
+                'layers': {layer: len(patches.get(layer, [])) for layer in h5i.get_layers(mapname)},
+                'patches': patches,
+                'valid_patches': len(h5i.get_valid_patches(mapname)),
+            }
+            entries[mapname].update(map_footprint(h5i.get_crs(mapname), h5i.get_transform(mapname),
+                                                  h5i.get_map_size(mapname)))
+    finally:
+        h5i.close()
+    return entries
+
+
+def load_catalog(folder, catalog=CATALOG_FILE):
+    """
+    Load the catalog of a folder.
+    :param folder: folder with the HDF5 files
+    :param catalog: name of the catalog file in the folder
+    :return: dict with for each map the catalog entry, None if there is no (valid) catalog
+    """
+    filename = os.path.join(folder, catalog)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except ValueError as e:
+        logging.warning(f"Error loading catalog {filename} : {e}")
+        return None
+    if data.get('version') != CATALOG_VERSION:
+        logging.warning(f"Ignoring catalog {filename} with version {data.get('version')}")
+        return None
+    return data['maps']
+
+
+def save_catalog(folder, maps, catalog=CATALOG_FILE):
+    """
+    Save the catalog of a folder. The file is replaced atomically, so readers never see
+    a partial catalog.
+    :param folder: folder with the HDF5 files
+    :param maps: dict with for each map the catalog entry
+    :param catalog: name of the catalog file in the folder
+    """
+    filename = os.path.join(folder, catalog)
+    tmpfile = f"{filename}.{os.getpid()}.tmp"
+    with open(tmpfile, "w") as f:
+        json.dump({'version': CATALOG_VERSION, 'maps': maps}, f)
+    os.replace(tmpfile, filename)
+
+
+def update_catalog(folder, h5file, catalog=CATALOG_FILE):
+    """
+    Add or update the maps of a single HDF5 file in the catalog of the folder.
+    :param folder: folder with the HDF5 files
+    :param h5file: the HDF5 file that was added or changed
+    :param catalog: name of the catalog file in the folder
+    """
+    maps = load_catalog(folder, catalog) or {}
+    filename = os.path.relpath(h5file, folder)
+    maps = {k: v for k, v in maps.items() if v['file'] != filename}
+    maps.update(catalog_entries(h5file, folder))
+    save_catalog(folder, maps, catalog)
+
+
+def build_catalog(folder, pattern="*.hdf5", catalog=CATALOG_FILE):
+    """
+    Create the catalog for all HDF5 files in the folder. Files that did not change since
+    the last catalog was written are not opened again, unless their entries have no footprint
+    or patches (written before these were added to the catalog).
+    :param folder: folder with the HDF5 files
+    :param pattern: pattern used to find the HDF5 files in the folder
+    :param catalog: name of the catalog file in the folder
+    :return: dict with for each map the catalog entry
+    """
+    old = {}
+    for mapname, entry in (load_catalog(folder, catalog) or {}).items():
+        old.setdefault(entry['file'], {})[mapname] = entry
+    maps = {}
+    for h5file in sorted(glob.glob(os.path.join(folder, pattern))):
+        filename = os.path.relpath(h5file, folder)
+        stat = os.stat(h5file)
+        entries = old.get(filename, {})
+        if entries and all(e['mtime'] == stat.st_mtime and e['filesize'] == stat.st_size and 'bounds' in e
+                           and 'patches' in e for e in entries.values()):
+            maps.update(entries)
+        else:
+            try:
+                maps.update(catalog_entries(h5file, folder))
+            except (OSError, KeyError) as e:
+                logging.warning(f"Error reading {h5file} : {e}")
+    save_catalog(folder, maps, catalog)
+    return maps
+
+
+def h5catalog():
+    parser = argparse.ArgumentParser(description='Create catalog of HDF5 files in a folder.')
+    parser.add_argument('folder', type=pathlib.Path, nargs='+',
+                        help='folder with HDF5 files')
+    parser.add_argument('--pattern', default='*.hdf5',
+                        help='pattern of HDF5 files (default: *.hdf5)')
+    args = parser.parse_args()
+    for folder in args.folder:
+        maps = build_catalog(folder, args.pattern)
+        print(folder, len(maps))
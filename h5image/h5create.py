@@ -1,23 +1,67 @@
 import argparse
+import concurrent.futures
 import pathlib
 
 import glob
 import os.path
 import time
 from h5image import H5Image
+from h5image.h5catalog import update_catalog
 
 
-def h5convert(input, output, patch=256, border=3):
+def _h5convert_map(file, h5path, patch, border, layer_workers, compression, overviews):
+    """
+    Convert a single json file, and the images with the same prefix, to a HDF5 file.
+    :param file: the json file
+    :param h5path: the HDF5 file to create
+    :param patch: patch size
+    :param border: patch border
+    :param layer_workers: number of threads used to read the layers
+    :param compression: compression of the images, see H5Image
+    :param overviews: number of overview levels, see H5Image
+    :return: time it took to convert the map
+    """
+    h5i = H5Image(h5path, "w", compression=compression, patch_size=patch, patch_border=border, overviews=overviews)
+    t = time.time()
+    h5i.add_image(file, workers=layer_workers)
+    h5i.close()
+    return time.time() - t
+
+
+def h5convert(input, output, patch=256, border=3, workers=1, layer_workers=1, compression="lzf", overviews=0):
+    """
+    Convert all json files, and the images with the same prefix, in the input folder to
+    HDF5 files, one file per map, in {output}/{patch}/{border}.
+    :param input: folder with json files and images
+    :param output: folder for the HDF5 files
+    :param patch: patch size
+    :param border: patch border
+    :param workers: number of maps to convert in parallel, each in its own process
+    :param layer_workers: number of threads used to read the layers of a map
+    :param compression: compression of the images, see H5Image
+    :param overviews: number of overview levels, see H5Image
+    """
+    jobs = []
     for file in glob.glob(f"{input}/*.json"):
         h5file = os.path.basename(file).replace('.json', '.hdf5')
         h5path = f"{output}/{patch}/{border}/{h5file}"
         os.makedirs(os.path.dirname(h5path), exist_ok=True)
         if not os.path.exists(h5path):
-            h5i = H5Image(h5path, "w", patch_size=patch, patch_border=border)
-            t = time.time()
-            h5i.add_image(file)
-            print(os.path.basename(file), time.time() - t)
-            h5i.close()
+            jobs.append((file, h5path))
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_h5convert_map, file, h5path, patch, border, layer_workers,
+                                       compression, overviews): (file, h5path)
+                       for file, h5path in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                file, h5path = futures[future]
+                print(os.path.basename(file), future.result())
+                update_catalog(os.path.dirname(h5path), h5path)
+    else:
+        for file, h5path in jobs:
+            print(os.path.basename(file),
+                  _h5convert_map(file, h5path, patch, border, layer_workers, compression, overviews))
+            update_catalog(os.path.dirname(h5path), h5path)
 
 
 def h5create():
@@ -30,5 +74,15 @@ def h5create():
                         help='patch size (default: 256)')
     parser.add_argument('--border', type=int, default=3,
                         help='patch size (default: 3)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of maps to convert in parallel (default: 1)')
+    parser.add_argument('--layer-workers', type=int, default=1,
+                        help='number of threads to read layers of a map (default: 1)')
+    parser.add_argument('--compression', default='lzf',
+                        help='compression: lzf, gzip, blosc-lz4, blosc-zstd, lz4, zstd, auto or none (default: lzf)')
+    parser.add_argument('--overviews', type=int, default=0,
+                        help='number of overview levels (default: 0)')
     args = parser.parse_args()
-    h5convert(args.input, args.output, args.patch, args.border)
+    compression = None if args.compression == 'none' else args.compression
+    h5convert(args.input, args.output, args.patch, args.border, args.workers, args.layer_workers, compression,
+              args.overviews)
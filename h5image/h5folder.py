@@ -0,0 +1,553 @@
+import collections
+import contextlib
+import glob
+import os.path
+import threading
+
+import h5py
+import numpy as np
+
+from .h5catalog import CATALOG_FILE, load_catalog
+from .h5image import H5Image, patches_by_location, valid_patches
+from .h5spatial import LONLAT, SpatialIndex, bounds_intersect, footprint_transform, map_footprint, \
+    patches_in_bounds, transform_bounds
+
+
+class H5Folder:
+    """Class to read images from all HDF5 files in a folder"""
+
+    # initialize the class
+    def __init__(self, folder, max_open_files=32, pattern="*.hdf5", catalog=CATALOG_FILE, **kwargs):
+        """
+        Create a new H5Folder object. If the folder has a catalog (see h5catalog) it is used to
+        find the maps, their size, layers and patches without opening the files. Any other
+        HDF5 file in the folder is assumed to contain a single map with the same name as the
+        file (as written by h5create). Files are only opened when a map is used, and at most
+        max_open_files are kept open at the same time, the least recently used file is closed first.
+        The object can be pickled, or used in a forked process, the files are opened again in the
+        new process when they are used.
+        :param folder: folder with the HDF5 files
+        :param max_open_files: maximum number of files to keep open
+        :param pattern: pattern used to find the HDF5 files in the folder
+        :param catalog: name of the catalog file in the folder, None to not use a catalog
+        :param kwargs: extra arguments passed to H5Image when opening a file
+        """
+        self.folder = folder
+        self.max_open_files = max_open_files
+        self.kwargs = kwargs
+        self.catalog = (load_catalog(folder, catalog) if catalog else None) or {}
+        self._files = {mapname: os.path.join(folder, entry['file']) for mapname, entry in self.catalog.items()}
+        known = set(self._files.values())
+        for filename in sorted(glob.glob(os.path.join(folder, pattern))):
+            if filename in known:
+                continue
+            mapname = os.path.splitext(os.path.basename(filename))[0]
+            self._files[mapname] = filename
+        self._images = collections.OrderedDict()
+        self._leases = collections.Counter()
+        self._evicted = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._footprints = {}
+        self._spatial = {}
+        self._patch_size = None
+
+    def __getstate__(self):
+        """
+        Only the configuration is pickled, the files are opened again when they are used.
+        :return: state of the object
+        """
+        state = self.__dict__.copy()
+        for key in ('_images', '_leases', '_evicted', '_lock'):
+            del state[key]
+        state['_spatial'] = {}
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore the configuration of a pickled object.
+        :param state: state of the object
+        """
+        self.__dict__.update(state)
+        self._images = collections.OrderedDict()
+        self._leases = collections.Counter()
+        self._evicted = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    # close all files
+    def close(self):
+        """
+        Close all open files, including files that are still in use by other threads.
+        """
+        with self._lock:
+            while self._images:
+                self._images.popitem(last=False)[1].close()
+            while self._evicted:
+                self._evicted.pop().close()
+            self._leases.clear()
+
+    def __str__(self):
+        """
+        String representation of the object
+        :return: string representation
+        """
+        return f"H5Folder(folder={self.folder}, #maps={len(self._files)}, #open={len(self._images)})"
+
+    @contextlib.contextmanager
+    def _use_image(self, mapname):
+        """
+        Helper function to use the H5Image with the map, opening the file if needed. The image
+        is leased while it is used, when more than max_open_files are open the least recently
+        used image is closed, but an image that is still leased by another thread is only
+        closed when its last lease is returned.
+        :param mapname: the name of the map
+        :return: context manager with the H5Image with the map
+        """
+        if self._pid != os.getpid():
+            # the lock could have been held by another thread while forking, the open
+            # images open their file again when used, the leases belong to threads of the
+            # parent process
+            self._lock = threading.Lock()
+            self._leases = collections.Counter()
+            while self._evicted:
+                self._evicted.pop().close()
+            self._pid = os.getpid()
+        with self._lock:
+            h5i = self._images.get(mapname)
+            if h5i is not None:
+                self._images.move_to_end(mapname)
+            else:
+                if mapname not in self._files:
+                    raise KeyError(f"Map not found: {mapname}")
+                h5i = H5Image(self._files[mapname], "r", **self.kwargs)
+                self._images[mapname] = h5i
+            self._leases[h5i] += 1
+            while len(self._images) > self.max_open_files:
+                evicted = self._images.popitem(last=False)[1]
+                if self._leases[evicted]:
+                    self._evicted.add(evicted)
+                else:
+                    evicted.close()
+        try:
+            yield h5i
+        finally:
+            with self._lock:
+                self._leases[h5i] -= 1
+                if self._leases[h5i] <= 0:
+                    del self._leases[h5i]
+                    if h5i in self._evicted:
+                        self._evicted.remove(h5i)
+                        h5i.close()
+
+    @property
+    def patch_size(self):
+        """
+        The patch size of the maps, all files in the folder are assumed to use the same patch
+        size. This is the patch size given when retiling, otherwise it is read from the catalog,
+        or from the attributes of the first file, without keeping the file open.
+        """
+        if self._patch_size is None:
+            maps = self.get_maps()
+            if self.kwargs.get('retile') or not maps:
+                self._patch_size = int(self.kwargs.get('patch_size', 256))
+            elif maps[0] in self.catalog:
+                self._patch_size = int(self.catalog[maps[0]]['patch_size'])
+            else:
+                with h5py.File(self._files[maps[0]], "r") as h5f:
+                    self._patch_size = int(h5f['/'].attrs.get('patch_size', 256))
+        return self._patch_size
+
+    def get_filename(self, mapname):
+        """
+        Returns the HDF5 file that contains the map.
+        :param mapname: the name of the map
+        :return: filename of the HDF5 file
+        """
+        return self._files[mapname]
+
+    # get list of all maps
+    def get_maps(self):
+        """
+        Returns a list of all maps in the folder.
+        :return: list of map names
+        """
+        return list(self._files.keys())
+
+    def get_map(self, mapname):
+        """
+        Returns the map as a numpy array. If this is a dataset of the file, it can only be used
+        until the file is closed, when max_open_files other maps are used.
+        :param mapname: the name of the map
+        :return: image as numpy array
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_map(mapname)
+
+    def get_map_size(self, mapname, level=0):
+        """
+        Returns the size of the map.
+        :param mapname: the name of the map
+        :param level: overview level, 0 for the full resolution
+        :return: size of the map
+        """
+        if mapname in self.catalog and level == 0:
+            return tuple(self.catalog[mapname]['shape'])
+        with self._use_image(mapname) as h5i:
+            return h5i.get_map_size(mapname, level)
+
+    def get_crs(self, mapname, layer='map'):
+        """
+        Returns the crs of the layer (defaults to the map).
+        :param mapname: the name of the map
+        :param layer: the name of the layer, defaults to the map
+        :return: crs of the map
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_crs(mapname, layer)
+
+    def get_transform(self, mapname, layer='map'):
+        """
+        Returns the transform of the layer (defaults to the map).
+        :param mapname: the name of the map
+        :param layer: the name of the layer, defaults to the map
+        :return: transform of the map
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_transform(mapname, layer)
+
+    def get_bounds(self, mapname, crs=None):
+        """
+        Returns the bounds of the map, from the catalog if possible.
+        :param mapname: the name of the map
+        :param crs: crs to return the bounds in, None for the crs of the map
+        :return: (left, bottom, right, top)
+        """
+        footprint = self._get_footprint(mapname)
+        if footprint['bounds'] is None:
+            raise ValueError(f"No transform stored for map of {mapname}")
+        if crs is None:
+            return tuple(footprint['bounds'])
+        if footprint['crs'] is None:
+            raise ValueError(f"No crs stored for map of {mapname}")
+        return transform_bounds(footprint['bounds'], footprint['crs'], crs)
+
+    def _get_footprint(self, mapname):
+        """
+        Helper function to get the footprint of a map (see h5spatial.map_footprint) with the size,
+        patch size and border of the map. The footprint is read from the catalog, maps that are
+        not in the catalog, or in a catalog without footprints, are opened once.
+        :param mapname: the name of the map
+        :return: footprint of the map
+        """
+        footprint = self._footprints.get(mapname)
+        if footprint is None:
+            entry = self.catalog.get(mapname)
+            if entry is not None and 'bounds' in entry:
+                footprint = entry
+            else:
+                with self._use_image(mapname) as h5i:
+                    footprint = map_footprint(h5i.get_crs(mapname), h5i.get_transform(mapname),
+                                              h5i.get_map_size(mapname))
+                    footprint.update({'shape': list(h5i.get_map_size(mapname)), 'patch_size': h5i.patch_size,
+                                      'patch_border': h5i.patch_border})
+            self._footprints[mapname] = footprint
+        return footprint
+
+    def _get_spatial_index(self, key):
+        """
+        Helper function to get the spatial index of the maps, built the first time it is used.
+        :param key: 'bounds' for the index in the crs of the maps, 'lonlat' for EPSG:4326
+        :return: SpatialIndex of the maps that have a footprint
+        """
+        index = self._spatial.get(key)
+        if index is None:
+            footprints = {mapname: self._get_footprint(mapname) for mapname in self.get_maps()}
+            index = SpatialIndex({mapname: footprint[key] for mapname, footprint in footprints.items()
+                                  if footprint[key] is not None})
+            self._spatial[key] = index
+        return index
+
+    def get_maps_in_bounds(self, bounds, crs=None):
+        """
+        Returns the maps that intersect bounds, using a spatial index of the footprints of the
+        maps, so with a catalog no files are opened. Without crs the bounds are compared with
+        the bounds of the maps in their own crs, which is only useful if all maps use the same
+        crs. With a crs, the maps are found using their footprint in EPSG:4326 and checked
+        using the bounds transformed to the crs of each map, maps without crs are skipped.
+        :param bounds: (left, bottom, right, top)
+        :param crs: crs of the bounds, None for the crs of the maps
+        :return: list of map names
+        """
+        if crs is None:
+            return self._get_spatial_index('bounds').intersection(bounds)
+        lonlat = transform_bounds(bounds, crs, LONLAT)
+        maps = []
+        for mapname in self._get_spatial_index('lonlat').intersection(lonlat):
+            footprint = self._get_footprint(mapname)
+            if bounds_intersect(transform_bounds(bounds, crs, footprint['crs']), footprint['bounds']):
+                maps.append(mapname)
+        return maps
+
+    def get_patches_in_bounds(self, bounds, crs=None, layer=None):
+        """
+        Returns the patches of all maps whose tile (the patch without its border) intersects
+        bounds. With a catalog, and without layer, no files are opened.
+        :param bounds: (left, bottom, right, top)
+        :param crs: crs of the bounds, None for the crs of the maps
+        :param layer: only return patches with data for this layer, None for all patches
+        :return: dict with for each map that has patches in the bounds the list of [row, col]
+        """
+        result = {}
+        for mapname in self.get_maps_in_bounds(bounds, crs):
+            if layer is not None or self.kwargs.get('retile'):
+                with self._use_image(mapname) as h5i:
+                    patches = h5i.get_patches_in_bounds(mapname, bounds, crs, layer)
+            else:
+                footprint = self._get_footprint(mapname)
+                map_bounds = bounds if crs is None else transform_bounds(bounds, crs, footprint['crs'])
+                tile_size = footprint['patch_size'] - 2 * footprint['patch_border']
+                patches = patches_in_bounds(map_bounds, footprint_transform(footprint), footprint['shape'], tile_size)
+            if patches:
+                result[mapname] = patches
+        return result
+
+    def get_map_corners(self, mapname):
+        """
+        Returns the bounds of the map.
+        :param mapname: the name of the map
+        :return: bounds of the map
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_map_corners(mapname)
+
+    def get_layers(self, mapname):
+        """
+        Returns a list of all layers for a map.
+        :param mapname: the name of the map
+        :return: list of layer names
+        """
+        if mapname in self.catalog:
+            return list(self.catalog[mapname]['layers'].keys())
+        with self._use_image(mapname) as h5i:
+            return h5i.get_layers(mapname)
+
+    def get_layer_patch_counts(self, mapname):
+        """
+        Returns the number of patches with data for each layer of the map.
+        :param mapname: the name of the map
+        :return: dict with for each layer the number of patches
+        """
+        if mapname in self.catalog and not self.kwargs.get('retile'):
+            return dict(self.catalog[mapname]['layers'])
+        return {layer: len(patches) for layer, patches in self.get_patches(mapname).items()}
+
+    def get_layer(self, mapname, layer):
+        """
+        Returns the layer as a numpy array. If this is a dataset of the file, it can only be used
+        until the file is closed, when max_open_files other maps are used.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :return: image as numpy array
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_layer(mapname, layer)
+
+    def _get_catalog_patches(self, mapname):
+        """
+        Helper function to get the patches of each layer of a map from the catalog.
+        :param mapname: the name of the map
+        :return: dict with for each layer the list of patches, None if the catalog has no patches
+                 for the map, or the patches are computed for another patch size (retile)
+        """
+        entry = self.catalog.get(mapname)
+        if entry is None or 'patches' not in entry or self.kwargs.get('retile'):
+            return None
+        return entry['patches']
+
+    def get_patches(self, mapname, by_location=False):
+        """
+        Returns a list of all patches for a map, see H5Image.get_patches. With a catalog the
+        patches are read from the catalog without opening the file.
+        :param mapname: the name of the map
+        :param by_location: if True, return a dictionary with locations as keys and layers as values
+        :return: list of patches
+        """
+        patches = self._get_catalog_patches(mapname)
+        if patches is None:
+            with self._use_image(mapname) as h5i:
+                return h5i.get_patches(mapname, by_location)
+        if by_location:
+            return patches_by_location(patches)
+        return {layer: [list(p) for p in locations] for layer, locations in patches.items()}
+
+    def get_valid_patches(self, mapname):
+        """
+        Returns a list of all valid patches for a map. With a catalog the patches are read
+        from the catalog without opening the file.
+        :param mapname: the name of the map
+        :return: list of valid patches
+        """
+        patches = self._get_catalog_patches(mapname)
+        if patches is None:
+            with self._use_image(mapname) as h5i:
+                return h5i.get_valid_patches(mapname)
+        return valid_patches(patches)
+
+    def get_all_valid_patches(self):
+        """
+        Returns the valid patches of all maps in the folder. With a catalog no files are
+        opened, otherwise every file is opened, one at a time, so this takes time proportional
+        to the number of files.
+        :return: list of valid patches as (mapname, row, col)
+        """
+        return [(mapname, row, col) for mapname in self.get_maps() for row, col in self.get_valid_patches(mapname)]
+
+    def get_patches_for_layer(self, mapname, layer, min_coverage=None):
+        """
+        Returns a list of all patches for a layer, see H5Image.get_patches_for_layer.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param min_coverage: minimum fraction (0 - 1) of pixels of a patch with data
+        :return: list of patches
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_patches_for_layer(mapname, layer, min_coverage)
+
+    def get_patch_coverage(self, mapname, layer):
+        """
+        Returns for each patch the fraction of the pixels where the layer has data.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :return: numpy array (rows x cols of patches) with the coverage of each patch
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_patch_coverage(mapname, layer)
+
+    def get_top_patches(self, mapname, layer, count=10):
+        """
+        Returns the patches where the layer has the highest coverage.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param count: number of patches to return
+        :return: list of (row, col, coverage), sorted by coverage, highest first
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_top_patches(mapname, layer, count)
+
+    def get_layers_for_patch(self, mapname, row, col):
+        """
+        Returns a list of all layers for a patch.
+        :param mapname: the name of the map
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :return: list of layers
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_layers_for_patch(mapname, row, col)
+
+    def get_legend(self, mapname, layer):
+        """
+        Returns the cropped image of the legend in the map.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :return: cropped image of legend
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_legend(mapname, layer)
+
+    def get_legends(self, mapname, layers=None):
+        """
+        Returns the cropped images of the legends of many layers.
+        :param mapname: the name of the map
+        :param layers: list of layer names, if None all layers of the map are used
+        :return: dict with for each layer the cropped image of the legend
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_legends(mapname, layers)
+
+    def get_patch(self, row, col, mapname, layer="map", level=0):
+        """
+        Returns the cropped image of the patch.
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param level: overview level, 0 for the full resolution
+        :return: cropped image of patch as a numpy array
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_patch(row, col, mapname, layer, level)
+
+    def get_overview_levels(self, mapname):
+        """
+        Returns the number of overview levels of a map.
+        :param mapname: the name of the map
+        :return: number of overview levels, 0 if the map has no overviews
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_overview_levels(mapname)
+
+    def get_window(self, mapname, window, layer='map', level=0, crs=None):
+        """
+        Returns a window of the map or a layer, see H5Image.get_window.
+        :param mapname: the name of the map
+        :param window: rasterio Window (col_off, row_off, width, height) in pixels of the level,
+                       or bounds (left, bottom, right, top)
+        :param layer: the name of the layer, defaults to the map
+        :param level: overview level, 0 for the full resolution
+        :param crs: crs of the bounds, None for the crs of the map
+        :return: window of the image as numpy array
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_window(mapname, window, layer, level, crs)
+
+    def get_patches_batch(self, locations, out=None):
+        """
+        Returns the cropped images of many patches as a single numpy array. The patches
+        are read grouped by map, see H5Image.get_patches_batch.
+        :param locations: list of (mapname, layer, row, col)
+        :param out: numpy array (N, patch_size, patch_size[, 3]) to write the patches into
+        :return: patches as a numpy array (N, patch_size, patch_size[, 3])
+        """
+        if len(locations) == 0:
+            if out is None:
+                return np.zeros((0, self.patch_size, self.patch_size), dtype=np.uint8)
+            if out.shape[0] != 0:
+                raise ValueError(f"Invalid output array, expected 0 patches, got {out.shape[0]}")
+            return out
+        maps = {}
+        for i, location in enumerate(locations):
+            maps.setdefault(location[0], []).append(i)
+        for mapname, indices in maps.items():
+            with self._use_image(mapname) as h5i:
+                patches = h5i.get_patches_batch([locations[i] for i in indices])
+            if out is None:
+                out = np.zeros((len(locations),) + patches.shape[1:], dtype=np.uint8)
+            elif out.shape[1:] != patches.shape[1:] or out.shape[0] != len(locations):
+                raise ValueError(f"Invalid output array, expected {patches.shape[1:]}, got {out.shape[1:]}")
+            out[indices] = patches
+        return out
+
+    def get_patch_stack(self, row, col, mapname, layers=None, include_map=False):
+        """
+        Returns the cropped images of many layers of the same patch as a single numpy array.
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :param mapname: the name of the map
+        :param layers: list of layer names, if None all layers of the map are used
+        :param include_map: if True also return the patch of the map
+        :return: patches as a numpy array (L, patch_size, patch_size)
+        """
+        with self._use_image(mapname) as h5i:
+            return h5i.get_patch_stack(row, col, mapname, layers, include_map)
+
+    def save_image(self, mapname, destination, layer=None):
+        """
+        Save the image to disk, see H5Image.save_image.
+        :param mapname: the name of the map
+        :param destination: the destination directory
+        :param layer: the name of the layer, if empty all layers are written
+        """
+        with self._use_image(mapname) as h5i:
+            h5i.save_image(mapname, destination, layer)
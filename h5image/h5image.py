@@ -1,77 +1,467 @@
+import collections
+import concurrent.futures
 import json
+import threading
 
 import affine
 import h5py
 import numpy as np
 import rasterio
+import rasterio.windows
 
 import math
 import os
 import os.path
 import logging
+import time
+
+from .h5cache import PatchCache
+from .h5spatial import bounds_to_window, patches_in_bounds, transform_bounds
+
+# lock used to reopen files in a new process
+_reopen_lock = threading.Lock()
+
+
+def _reset_reopen_lock():
+    """
+    Helper function to create a new reopen lock in a forked process, the lock of the
+    parent could have been held by another thread while forking.
+    """
+    global _reopen_lock
+    _reopen_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_reopen_lock)
+
+# codecs that need the hdf5plugin package
+PLUGIN_CODECS = ('blosc-lz4', 'blosc-zstd', 'lz4', 'zstd')
+# codecs tried when compression is "auto"
+AUTO_CODECS = ('lzf', 'gzip') + PLUGIN_CODECS
+# size in pixels of the cells of the patch index, used to compute the patches for any patch size
+CELL_SIZE = 32
+
+
+def _import_hdf5plugin(codec):
+    """
+    Helper function to import hdf5plugin, this registers the extra codecs with HDF5.
+    :param codec: the codec that needs the plugin, used in the error message
+    :return: the hdf5plugin module
+    """
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(f"Compression {codec} needs the hdf5plugin package, install it with: pip install hdf5plugin")
+    return hdf5plugin
+
+
+def _codec_args(codec):
+    """
+    Helper function to get the arguments for create_dataset to compress with a codec.
+    :param codec: name of the codec, None for no compression
+    :return: dict with arguments for create_dataset
+    """
+    if codec is None or codec == 'none':
+        return {}
+    if codec not in PLUGIN_CODECS:
+        return {'compression': codec}
+    hdf5plugin = _import_hdf5plugin(codec)
+    if codec == 'blosc-lz4':
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if codec == 'blosc-zstd':
+        return dict(hdf5plugin.Blosc(cname='zstd', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if codec == 'lz4':
+        return dict(hdf5plugin.LZ4())
+    return dict(hdf5plugin.Zstd())
+
+
+def patches_by_location(patches):
+    """
+    Group the patches of the layers of a map by location.
+    :param patches: dict with for each layer a list of [row, col] of the patches with data
+    :return: dict with for each location (row_col) the list of layers with data
+    """
+    layers_patch = {}
+    for layer, locations in patches.items():
+        for row, col in locations:
+            layers_patch.setdefault(f"{row}_{col}", []).append(layer)
+    return layers_patch
+
+
+def valid_patches(patches):
+    """
+    Returns the patches of a map where at least one layer has data.
+    :param patches: dict with for each layer a list of [row, col] of the patches with data
+    :return: list of [row, col], in the order of the locations of patches_by_location
+    """
+    locations = dict.fromkeys((row, col) for layer in patches.values() for row, col in layer)
+    return [[row, col] for row, col in locations]
 
 
 class H5Image:
     """Class to read and write images to HDF5 file"""
 
     # initialize the class
-    def __init__(self, h5file, mode='r', compression="lzf", patch_size=256, patch_border=3):
+    def __init__(self, h5file, mode='r', compression="lzf", patch_size=256, patch_border=3, patch_index=True,
+                 max_cached_maps=128, max_window_bytes=None, chunks="patch",
+                 pack_masks=False, sparse=False, cache_bytes=0, rdcc_nbytes=None, rdcc_nslots=None, overviews=0,
+                 retile=False, memmap=False):
         """
         Create a new H5Image object. The patches in the file are assumed to be square and will
         be cropped to the patch size. The patch border is used to add a border around the patch,
         the tile size is the patch size minus the border. The image will be split in tiles based
         on the tile size. Any area outside of the image will be filled with 0.
         If the file is opened as read-only, no images can be added to the file and the patch size,
-        border and compression are ignored.
+        border, compression and chunks are ignored.
+        The chunks of the images can be "patch" to use chunks of patch_size x patch_size, "tile"
+        to use chunks of tile_size x tile_size, "auto" to let h5py pick the chunk size, a tuple
+        (rows, cols), or None to store images contiguous (only without compression). A patch
+        touches at most 2 x 2 chunks of patch_size, but with a border every patch that is not at
+        the edge touches 3 x 3 chunks of tile_size, so "patch" reads less data for every patch.
+        The compression can be "lzf", "gzip", "blosc-lz4", "blosc-zstd", "lz4" or "zstd" (the
+        last four need the hdf5plugin package), None for no compression, or "auto" to compress
+        a few chunks of the first map and layer with every available codec and use the codec
+        that decodes fastest of the codecs within 10% of the smallest size. A dict with the
+        compression for "map", "layer" and "index" can be used to pick a codec per dataset.
+        The codec used is stored in the COMPRESSION attribute of each dataset.
+        If cache_bytes is set, the decoded patches returned by get_patch, get_patches_batch and
+        get_patch_stack are kept in a LRU cache of at most this many bytes, that is shared by all
+        threads using this object. The chunk cache of HDF5 itself can be tuned with rdcc_nbytes
+        and rdcc_nslots (see h5py.File).
+        The object can be pickled, only the configuration is stored, and the file is opened again
+        when it is first used in the new process. The same happens when the object is used in a
+        forked process. Files opened with mode 'w' are opened again with mode 'a'.
+        If overviews is set, that many overview levels are written for every image added, each
+        level is half the size of the previous level. The map is averaged, layers use the
+        maximum so masks stay visible. The levels can be read with get_patch and get_window.
+        The patch index also stores the pixels with data in cells of CELL_SIZE x CELL_SIZE pixels.
+        If retile is set, a read-only file is opened with the patch size and border given instead
+        of the values in the file, and the patches of the layers and their coverage are computed
+        from the cells. This is exact if the tile size and border are multiples of CELL_SIZE,
+        otherwise every cell touching a patch is counted, so the patches can include a few
+        patches without data, but never miss a patch with data.
+        If memmap is set, images stored contiguous and uncompressed (chunks=None, compression=None)
+        are mapped in memory with numpy.memmap, and patches and windows inside the image are
+        returned as read-only views of the file without copying. Patches at the edge of the image
+        are copied, to add the area outside of the image.
         :param h5file: filename on disk
         :param mode: set to 'r' for read-only, 'w' for write, 'a' for append
-        :param compression: compression type, None for no compression
+        :param compression: compression type, "auto", a dict per dataset, or None for no compression
         :param patch_size: size of patch, used to crop image and calculate good patches
         :param patch_border: border around patch, used to crop image and calculate good patches
+        :param patch_index: write the binary patch index for new maps, and for maps without an index when a
+                            layer is added (layers added to a map with an index are always indexed)
+        :param max_cached_maps: number of maps to keep parsed metadata for, 0 to disable caching
+        :param max_window_bytes: if set, images are read and written in windows of rows of at most
+                                 this size, instead of reading the whole image in memory
+        :param chunks: chunk layout of the images, "patch", "tile", "auto", (rows, cols) or None
+        :param pack_masks: store layers that only have values 0 and 1 with 8 pixels per byte, this
+                           is not done for layers that are streamed (see max_window_bytes)
+        :param sparse: only write chunks of the images that have data, chunks that are not written
+                       are read as 0 (needs chunks)
+        :param cache_bytes: size of the cache of decoded patches in bytes, 0 to disable the cache
+        :param rdcc_nbytes: size of the HDF5 chunk cache of each dataset in bytes, None for the default
+        :param rdcc_nslots: number of slots in the HDF5 chunk cache of each dataset, None for the default
+        :param overviews: number of overview levels to write for new images
+        :param retile: use the patch size and border given when reading, instead of the file values
+        :param memmap: return views of the file for images stored contiguous and uncompressed
         """
         self.h5file = h5file
         self.mode = mode
+        self.patch_index = patch_index
+        self.max_cached_maps = max_cached_maps
+        self.max_window_bytes = max_window_bytes
+        self.pack_masks = pack_masks
+        self.sparse = sparse
+        self.overviews = overviews
+        self.retile = retile
+        self.memmap = memmap
+        self._retiled = False
+        self.cache_bytes = cache_bytes
+        self._metadata = collections.OrderedDict()
+        self._metadata_lock = threading.Lock()
+        self._auto_codecs = {}
+        self.cache = PatchCache(cache_bytes) if cache_bytes > 0 else None
+        self._file_args = {k: v for k, v in (('rdcc_nbytes', rdcc_nbytes), ('rdcc_nslots', rdcc_nslots))
+                           if v is not None}
+        self._pid = os.getpid()
         if mode == 'w':
-            if os.path.exists(h5file):
-                self.h5f = h5py.File(h5file, mode)
-                self.compression = self.h5f['/'].attrs.get('compression', compression.encode('utf-8')).decode('utf-8')
-                if self.compression != compression:
-                    logging.warning(f"compression mismatch, file: {self.compression}, parameter: {compression}, using file value")
-                self.patch_size = self.h5f['/'].attrs.get('patch_size', patch_size)
-                if self.patch_size != patch_size:
-                    logging.warning(f"patch_size mismatch, file: {self.patch_size}, parameter: {patch_size}, using file value")
-                self.patch_border = self.h5f['/'].attrs.get('patch_border', patch_border)
-                if self.patch_border != patch_border:
-                    logging.warning(f"patch_border mismatch, file: {self.patch_border}, parameter: {patch_border}, using file value")
-            else:
-                self.h5f = h5py.File(h5file, mode)
-                self.h5f['/'].attrs.create('compression', compression, dtype=f'S{len(compression)}')
-                self.h5f['/'].attrs.create('patch_size', patch_size, dtype=np.uint16)
-                self.h5f['/'].attrs.create('patch_border', patch_border, dtype=np.uint16)
-                self.compression = compression
-                self.patch_size = patch_size
-                self.patch_border = patch_border                
+            self._h5f = h5py.File(h5file, mode, **self._file_args)
+            self._write_setting('compression', compression)
+            self._write_setting('patch_size', patch_size)
+            self._write_setting('patch_border', patch_border)
+            self._write_setting('chunks', chunks)
+            self.compression = compression
+            self.patch_size = patch_size
+            self.patch_border = patch_border
+            self.chunks = chunks
         else:
             if not os.path.exists(h5file):
                 logging.error(f"File not found: {h5file}")
-            self.h5f = h5py.File(h5file, mode)
-            self.compression = self.h5f['/'].attrs.get('compression', compression.encode('utf-8')).decode('utf-8')
-            if self.compression != compression:
-                logging.warning(f"compression mismatch, file: {self.compression}, parameter: {compression}, using file value")
-            self.patch_size = self.h5f['/'].attrs.get('patch_size', patch_size)
-            if self.patch_size != patch_size:
-                logging.warning(f"patch_size mismatch, file: {self.patch_size}, parameter: {patch_size}, using file value")
-            self.patch_border = self.h5f['/'].attrs.get('patch_border', patch_border)
-            if self.patch_border != patch_border:
-                logging.warning(f"patch_border mismatch, file: {self.patch_border}, parameter: {patch_border}, using file value")
+            if retile and mode != 'r':
+                raise ValueError("retile can only be used to read files")
+            self._h5f = h5py.File(h5file, mode, **self._file_args)
+            self.compression = self._read_setting('compression', compression)
+            if retile:
+                attrs = self.h5f['/'].attrs
+                stored = (int(attrs.get('patch_size', -1)), int(attrs.get('patch_border', -1)))
+                self.patch_size = patch_size
+                self.patch_border = patch_border
+                self._retiled = stored != (patch_size, patch_border)
+            else:
+                self.patch_size = self._read_setting('patch_size', patch_size)
+                self.patch_border = self._read_setting('patch_border', patch_border)
+            # the chunks are only used to add images, no need to warn when reading
+            self.chunks = self._read_setting('chunks', chunks, warn=mode != 'r')
+            self._load_codecs()
         self.tile_size = self.patch_size - (2 * self.patch_border)
 
+    def _write_setting(self, name, value):
+        """
+        Helper function to store a setting in the root attributes of the file.
+        :param name: name of the setting
+        :param value: value of the setting, a number, string, tuple of numbers, dict or None
+        """
+        if isinstance(value, (int, np.integer)):
+            self.h5f['/'].attrs.create(name, value, dtype=np.uint16)
+        else:
+            if value is None:
+                txt = 'none'
+            elif isinstance(value, dict):
+                txt = json.dumps(value)
+            elif isinstance(value, (tuple, list)):
+                txt = ','.join(str(v) for v in value)
+            else:
+                txt = value
+            self.h5f['/'].attrs.create(name, txt, dtype=f'S{len(txt)}')
+
+    def _read_setting(self, name, value, warn=True):
+        """
+        Helper function to read a setting from the root attributes of the file. If the
+        file has the setting it is used, and a warning is logged if it is different from
+        the parameter.
+        :param name: name of the setting
+        :param value: value passed as parameter, used if the file does not have the setting
+        :param warn: log a warning if the setting is different from the parameter
+        :return: value of the setting
+        """
+        if name not in self.h5f['/'].attrs:
+            return value
+        stored = self.h5f['/'].attrs[name]
+        if isinstance(stored, bytes):
+            stored = stored.decode('utf-8')
+            if stored == 'none':
+                stored = None
+            elif stored.startswith('{'):
+                stored = json.loads(stored)
+            elif ',' in stored:
+                stored = tuple(int(v) for v in stored.split(','))
+        else:
+            # attributes are read as numpy scalars, which overflow when computing negative offsets
+            stored = int(stored)
+        if isinstance(value, list):
+            value = tuple(value)
+        if warn and stored != value:
+            logging.warning(f"{name} mismatch, file: {stored}, parameter: {value}, using file value")
+        return stored
+
+    def _load_codecs(self):
+        """
+        Helper function to make the codecs used by the file available when reading. If the
+        hdf5plugin package is missing, an error is logged, and reading the datasets that use
+        these codecs will fail.
+        """
+        compression = self.compression
+        codecs = set(compression.values()) if isinstance(compression, dict) else {compression}
+        needed = codecs & set(PLUGIN_CODECS + ('auto',))
+        if needed:
+            try:
+                _import_hdf5plugin(', '.join(sorted(needed)))
+            except ImportError as e:
+                logging.error(f"{self.h5file} : {e}")
+
+    def _select_codec(self, kind, sample=None, chunks=None):
+        """
+        Helper function to select the codec for a new dataset. If compression is "auto" the
+        codec is picked the first time a dataset of this kind is created, and used for all
+        other datasets of this kind.
+        :param kind: kind of dataset, "map", "layer", "packed" (bit packed layer) or "index"
+        :param sample: function returning data of the dataset, used if compression is "auto"
+        :param chunks: chunks of the dataset, used if compression is "auto"
+        :return: name of the codec, None for no compression
+        """
+        compression = self.compression
+        if isinstance(compression, dict):
+            compression = compression.get('layer' if kind == 'packed' else kind, 'lzf')
+        if compression != 'auto':
+            return compression
+        if kind == 'index' or sample is None:
+            return 'lzf'
+        if kind not in self._auto_codecs:
+            self._auto_codecs[kind] = self._benchmark_codecs(sample(), chunks)
+            logging.info(f"Using compression {self._auto_codecs[kind]} for {kind}")
+        return self._auto_codecs[kind]
+
+    def _benchmark_codecs(self, data, chunks):
+        """
+        Helper function to pick a codec for "auto" compression. Up to 8 chunks of the data
+        that are not empty are compressed in memory with every available codec. Of the codecs
+        within 10% of the smallest size, the codec that decodes the fastest is returned.
+        :param data: data as numpy array
+        :param chunks: chunks of the dataset
+        :return: name of the codec
+        """
+        if isinstance(chunks, tuple):
+            rows, cols = chunks[:2]
+        else:
+            rows, cols = min(self.tile_size, data.shape[0]), min(self.tile_size, data.shape[1])
+        blocks = np.argwhere(self._chunk_occupancy(data, rows, cols))
+        if len(blocks) == 0:
+            blocks = np.argwhere(np.ones((math.ceil(data.shape[0] / rows), math.ceil(data.shape[1] / cols))))
+        blocks = blocks[np.linspace(0, len(blocks) - 1, min(8, len(blocks))).astype(int)]
+        sample = np.zeros((len(blocks), rows, cols) + data.shape[2:], dtype=data.dtype)
+        for i, (x, y) in enumerate(blocks):
+            block = data[x * rows:(x + 1) * rows, y * cols:(y + 1) * cols]
+            sample[i, :block.shape[0], :block.shape[1]] = block
+        results = []
+        with h5py.File(f"benchmark-{id(self)}", 'w', driver='core', backing_store=False) as h5f:
+            for codec in AUTO_CODECS:
+                try:
+                    args = _codec_args(codec)
+                except ImportError:
+                    continue
+                dset = h5f.create_dataset(codec, data=sample, chunks=(1,) + sample.shape[1:], **args)
+                decode = math.inf
+                for _ in range(3):
+                    t = time.perf_counter()
+                    dset[...]
+                    decode = min(decode, time.perf_counter() - t)
+                results.append((dset.id.get_storage_size(), decode, codec))
+        smallest = min(size for size, _, _ in results)
+        return min((decode, codec) for size, decode, codec in results if size <= smallest * 1.1)[1]
+
+    def _read_error(self, dset, e):
+        """
+        Helper function to create the error raised when a dataset can not be read. If the
+        dataset uses a codec from hdf5plugin the error says so.
+        :param dset: dataset that could not be read
+        :param e: the original error
+        :return: error to raise
+        """
+        codec = dset.attrs.get('COMPRESSION', b'').decode('utf-8')
+        if codec in PLUGIN_CODECS:
+            return OSError(f"Error reading {dset.name} compressed with {codec}, this needs the hdf5plugin "
+                           f"package, install it with: pip install hdf5plugin ({e})")
+        return e
+
+    def _packed_width(self, dset):
+        """
+        Helper function to check if an image is stored bit packed.
+        :param dset: dataset of the image
+        :return: width of the unpacked image, None if the image is not bit packed
+        """
+        mapname = dset.name.split('/')[1]
+        return self._get_metadata(mapname, f"packed{dset.name}", lambda: self._load_packed_width(dset))
+
+    def _load_packed_width(self, dset):
+        """
+        Helper function to read the width of a bit packed image from the dataset attributes.
+        :param dset: dataset of the image
+        :return: width of the unpacked image, None if the image is not bit packed
+        """
+        if 'PACKED_WIDTH' in dset.attrs:
+            return int(dset.attrs['PACKED_WIDTH'])
+        return None
+
+    def _read_full(self, dset):
+        """
+        Helper function to read a full image, unpacking bit packed images.
+        :param dset: dataset of the image
+        :return: image as numpy array
+        """
+        packed_width = self._packed_width(dset)
+        try:
+            data = dset[...]
+        except OSError as e:
+            raise self._read_error(dset, e) from e
+        if packed_width is None:
+            return data
+        return np.unpackbits(data, axis=1, count=packed_width)
+
+    def _chunk_shape(self, shape):
+        """
+        Helper function to compute the chunks of an image dataset.
+        :param shape: shape of the image
+        :return: chunks argument for create_dataset
+        """
+        if self.chunks == 'auto':
+            return True
+        if self.chunks is None:
+            return None
+        if self.chunks == 'patch':
+            rows = cols = self.patch_size
+        elif self.chunks == 'tile':
+            rows = cols = self.tile_size
+        else:
+            rows, cols = self.chunks
+        return (min(rows, shape[0]), min(cols, shape[1])) + tuple(shape[2:])
+
     # close the file
     def close(self):
         """
-        Close the file
+        Close the file, if it was opened in this process
+        """
+        if self._h5f is not None and self._pid == os.getpid():
+            self._h5f.close()
+
+    @property
+    def h5f(self):
+        """
+        The HDF5 file, opened again if the object was pickled or is used in a forked process.
+        """
+        if self._pid != os.getpid():
+            with _reopen_lock:
+                if self._pid != os.getpid():
+                    self._reopen()
+        return self._h5f
+
+    def _reopen(self):
+        """
+        Helper function to open the file in a new process. A file inherited from the parent
+        process is not closed, since that could change the file of the parent, it is kept
+        so it is not closed when garbage collected.
+        """
+        if self._h5f is not None:
+            self._inherited = self._h5f
+        # locks could have been held by another thread while forking
+        self._metadata_lock = threading.Lock()
+        self.cache = PatchCache(self.cache_bytes) if self.cache_bytes > 0 else None
+        mode = 'r' if self.mode == 'r' else 'a'
+        self._h5f = h5py.File(self.h5file, mode, **self._file_args)
+        self._load_codecs()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        """
+        Only the configuration is pickled, the file is opened again when it is used.
+        :return: state of the object
         """
-        self.h5f.close()
+        state = self.__dict__.copy()
+        for key in ('_h5f', '_inherited', '_metadata', '_metadata_lock', 'cache'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore the configuration of a pickled object, the file is opened when it is used.
+        :param state: state of the object
+        """
+        self.__dict__.update(state)
+        self._h5f = None
+        self._pid = None
+        self._metadata = collections.OrderedDict()
+        self._metadata_lock = threading.Lock()
+        self.cache = PatchCache(self.cache_bytes) if self.cache_bytes > 0 else None
 
     def __str__(self):
         """
@@ -81,87 +471,778 @@ class H5Image:
         return f"H5Image(filename={self.h5file}, mode={self.mode}, patch_size={self.patch_size}, patch_border={self.patch_border}, tile_size={self.tile_size}, #maps={len(self.get_maps())})"
 
     # crop image
-    def _crop_image(self, dset, x, y):
+    def _crop_image(self, dset, x, y, out=None):
         """
         Helper function to crop an image.
-        :param dset: the hdf5 dataset to crop
+        :param dset: the hdf5 dataset to crop, or the image mapped in memory (see _get_memmap)
         :param x: upper left x coordinate
         :param y: upper left y coordinate
+        :param out: numpy array to write the patch into, if None a new array is created
         :return: cropped image as numpy array
         """
-        if x < 0 or x > dset.shape[0]:
+        packed_width = None if isinstance(dset, np.ndarray) else self._packed_width(dset)
+        height = dset.shape[0]
+        width = dset.shape[1] if packed_width is None else packed_width
+        if x < 0 or x > height:
             logging.error(f"Invalid x coordinate {x}")
             return None
-        if y < 0 or y > dset.shape[1]:
+        if y < 0 or y > width:
             logging.error(f"Invalid y coordinate {y}")
             return None
-        dst_x1 = dst_y1 = 0
-        src_x1 = (x*self.tile_size) - self.patch_border
-        if src_x1 < 0:
-            dst_x1 = -src_x1
-            src_x1 = 0
-        src_x2 = (x*self.tile_size) + self.tile_size + self.patch_border
-        if src_x2 > dset.shape[0]:
-            src_x2 = dset.shape[0]
-        src_y1 = (y*self.tile_size) - self.patch_border
-        if src_y1 < 0:
-            dst_y1 = -src_y1
-            src_y1 = 0
-        src_y2 = (y*self.tile_size) + self.tile_size + self.patch_border
-        if src_y2 > dset.shape[1]:
-            src_y2 = dset.shape[1]
+        return self._read_window(dset, (x * self.tile_size) - self.patch_border,
+                                 (y * self.tile_size) - self.patch_border, self.patch_size, self.patch_size, out)
+
+    def _read_window(self, dset, row, col, height, width, out=None):
+        """
+        Helper function to read a window of an image, any area outside of the image is
+        filled with 0. Bit packed images are unpacked. For an image mapped in memory, a
+        window inside the image is returned as a view of the file.
+        :param dset: the hdf5 dataset to read, or the image mapped in memory (see _get_memmap)
+        :param row: first row of the window, can be negative
+        :param col: first column of the window, can be negative
+        :param height: rows of the window
+        :param width: columns of the window
+        :param out: numpy array to write the window into, if None a new array is created
+        :return: window of the image as numpy array
+        """
+        mapped = isinstance(dset, np.ndarray)
+        packed_width = None if mapped else self._packed_width(dset)
+        src_x1 = max(row, 0)
+        src_x2 = min(row + height, dset.shape[0])
+        src_y1 = max(col, 0)
+        src_y2 = min(col + width, dset.shape[1] if packed_width is None else packed_width)
+        dst_x1 = src_x1 - row
+        dst_y1 = src_y1 - col
         dst_x2 = dst_x1 + src_x2 - src_x1
         dst_y2 = dst_y1 + src_y2 - src_y1
         src = np.s_[src_x1:src_x2, src_y1:src_y2]
         dst = np.s_[dst_x1:dst_x2, dst_y1:dst_y2]
-        if len(dset.shape) == 3 and dset.shape[2] == 3:
-            rgb = np.zeros((self.patch_size, self.patch_size, 3), dtype=np.uint8)
+        if mapped and out is None and dst_x2 - dst_x1 == height and dst_y2 - dst_y1 == width:
+            # window is inside the image, no need to copy
+            return dset[src]
+        if out is not None:
+            rgb = out
+            if dst_x2 - dst_x1 != height or dst_y2 - dst_y1 != width:
+                rgb[...] = 0
+        elif len(dset.shape) == 3 and dset.shape[2] == 3:
+            rgb = np.zeros((height, width, 3), dtype=np.uint8)
         else:
-            rgb = np.zeros((self.patch_size, self.patch_size), dtype=np.uint8)
+            rgb = np.zeros((height, width), dtype=np.uint8)
+        if src_x2 <= src_x1 or src_y2 <= src_y1:
+            return rgb
         try:
-            dset.read_direct(rgb, src, dst)
-        except TypeError as e:
+            if mapped:
+                rgb[dst] = dset[src]
+            elif packed_width is None:
+                dset.read_direct(rgb, src, dst)
+            else:
+                # only read and unpack the bytes covering the columns of the window
+                b1 = src_y1 // 8
+                bits = np.unpackbits(dset[src_x1:src_x2, b1:(src_y2 + 7) // 8], axis=1)
+                rgb[dst] = bits[:, src_y1 - 8 * b1:src_y2 - 8 * b1]
+        except (TypeError, ValueError) as e:
             logging.warn(f"{src_x1}, {src_x2}, {src_y1}, {src_y2}, {dst_x1}, {dst_x2}, {dst_y1}, {dst_y2}")
             logging.error(f"Error reading {dset.name} : {e}")
+        except OSError as e:
+            raise self._read_error(dset, e) from e
         return rgb
 
-    def _add_image(self, filename, name, group):
+    def _get_memmap(self, mapname, layer, level=0):
         """
-        Helper function to add an image to the file
+        Helper function to map an image stored contiguous and uncompressed in memory. The
+        location of the data in the file is read from HDF5, and the data is mapped read-only.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param level: overview level
+        :return: numpy array mapped to the file, None if memmap is not set or the image is
+                 chunked, bit packed or not written yet
+        """
+        if not self.memmap:
+            return None
+
+        def loader():
+            dset = self._get_dataset(mapname, layer, level)
+            if dset.chunks is not None or self._packed_width(dset) is not None:
+                return None
+            offset = dset.id.get_offset()
+            if offset is None:
+                return None
+            return np.asarray(np.memmap(self.h5file, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape))
+        return self._get_metadata(mapname, f"memmap/{level}/{layer}", loader)
+
+    def _get_metadata(self, mapname, key, loader):
+        """
+        Helper function to get parsed metadata of a map from the cache. The value is
+        computed using loader the first time it is requested. Only the most recently used
+        maps are kept. The values returned are shared and should not be modified.
+        :param mapname: the name of the map
+        :param key: the name of the metadata
+        :param loader: function to compute the value if it is not in the cache
+        :return: the value of the metadata
+        """
+        if self.max_cached_maps <= 0:
+            return loader()
+        with self._metadata_lock:
+            metadata = self._metadata.get(mapname)
+            if metadata is None:
+                metadata = self._metadata[mapname] = {}
+                while len(self._metadata) > self.max_cached_maps:
+                    self._metadata.popitem(last=False)
+            else:
+                self._metadata.move_to_end(mapname)
+            if key in metadata:
+                return metadata[key]
+        value = loader()
+        with self._metadata_lock:
+            metadata[key] = value
+        return value
+
+    def _invalidate_metadata(self, mapname):
+        """
+        Helper function to remove the cached metadata and patches of a map, called when the
+        map changes.
+        :param mapname: the name of the map
+        """
+        with self._metadata_lock:
+            self._metadata.pop(mapname, None)
+        if self.cache is not None:
+            self.cache.invalidate(mapname)
+
+    def _read_patch(self, mapname, layer, row, col, out=None, level=0):
+        """
+        Helper function to read a patch, using the cache of decoded patches if enabled. Patches
+        of images that are mapped in memory are not cached, since they are not decoded.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :param out: numpy array to write the patch into, if None a new array is created
+        :param level: overview level
+        :return: cropped image of patch as a numpy array
+        """
+        mapped = self._get_memmap(mapname, layer, level)
+        if mapped is not None:
+            return self._crop_image(mapped, row, col, out=out)
+        dset = self._get_dataset(mapname, layer, level)
+        if self.cache is None:
+            return self._crop_image(dset, row, col, out=out)
+        key = (mapname, layer, row, col, level)
+        patch = self.cache.get(key)
+        if patch is None:
+            patch = self._crop_image(dset, row, col, out=out)
+            if patch is not None:
+                self.cache.put(key, patch.copy())
+            return patch
+        if out is None:
+            return patch.copy()
+        out[...] = patch
+        return out
+
+    def _get_json(self, mapname):
+        """
+        Helper function to get the parsed json of a map.
+        :param mapname: the name of the map
+        :return: json data of the map
+        """
+        return self._get_metadata(mapname, 'json', lambda: json.loads(self.h5f[mapname].attrs['json']))
+
+    def _get_legend_bounds(self, mapname):
+        """
+        Helper function to get the bounding box of the legend of each layer. If a label is
+        used multiple times the first shape is used.
+        :param mapname: the name of the map
+        :return: dict with for each layer the legend bounds (x1, x2, y1, y2)
+        """
+        def loader():
+            legends = {}
+            for shape in self._get_json(mapname)['shapes']:
+                # points in array are floats
+                y, x = zip(*shape['points'])
+                legends.setdefault(shape['label'], (int(min(x)), int(max(x)), int(min(y)), int(max(y))))
+            return legends
+        return self._get_metadata(mapname, 'legends', loader)
+
+    def _patch_count(self, size):
+        """
+        Helper function to compute the number of patches that overlap an image, including the
+        border of the patches. This can be one more than the patches of an image of this size,
+        so a layer smaller than the map still counts the patches of the map that only overlap
+        the layer with their border.
+        :param size: size of the image along one axis
+        :return: number of patches
+        """
+        return math.ceil((size + self.patch_border) / self.tile_size)
+
+    def _reduce_patches(self, counts, axis):
+        """
+        Helper function to sum one axis of an array of pixel counts from pixels to patches.
+        Neighbouring patches overlap by twice the border, so the axis is split at every patch
+        start and end, each segment is summed once, and the segments are combined for each patch.
+        :param counts: numpy array with counts (or a boolean mask)
+        :param axis: axis to reduce
+        :return: numpy array (uint64) with the axis reduced to the number of patches
+        """
+        size = counts.shape[axis]
+        count = self._patch_count(size)
+        starts = np.clip(np.arange(count) * self.tile_size - self.patch_border, 0, size)
+        ends = np.clip(np.arange(count) * self.tile_size + self.tile_size + self.patch_border, 0, size)
+        bounds = np.unique(np.concatenate((starts, ends)))
+        bounds = bounds[bounds < size]
+        if counts.dtype == bool:
+            # a segment is at most a patch long, summing bytes is faster than booleans
+            segments = np.add.reduceat(counts.view(np.uint8), bounds, axis=axis, dtype=np.uint16)
+        else:
+            segments = np.add.reduceat(counts, bounds, axis=axis, dtype=np.uint64)
+        # sum of the segments before each boundary
+        total = np.insert(np.cumsum(segments, axis=axis, dtype=np.uint64), 0, 0, axis=axis)
+        first = np.take(total, np.searchsorted(bounds, starts), axis=axis)
+        last = np.take(total, np.searchsorted(bounds, ends), axis=axis)
+        return last - first
+
+    def _count_pixels(self, image):
+        """
+        Helper function to count the pixels with data in every patch of an image, including
+        the border of the patch, and in every cell of CELL_SIZE x CELL_SIZE pixels. The
+        patches with a count above 0 are the same as the patches returned by _crop_image
+        that have an average above 0.
+        :param image: image as numpy array
+        :return: numpy array (rows x cols of patches, uint32) with the pixels with data in each
+                 patch, and numpy array (rows x cols of cells, uint16) with the pixels with data
+                 in each cell
+        """
+        mask = image != 0
+        if mask.ndim == 3:
+            mask = mask.any(axis=2)
+        cells = np.zeros(self._cell_shape(mask.shape), dtype=np.uint16)
+        self._add_cell_counts(cells, mask, 0)
+        counts = self._reduce_patches(mask, 0)
+        return self._reduce_patches(counts, 1).astype(np.uint32), cells
+
+    def _cell_shape(self, shape):
+        """
+        Helper function to compute the number of cells of an image.
+        :param shape: shape of the image
+        :return: rows and cols of cells
+        """
+        return math.ceil(shape[0] / CELL_SIZE), math.ceil(shape[1] / CELL_SIZE)
+
+    def _layer_patches(self, group, coverage):
+        """
+        Helper function to list the patches with data of a layer, only the patches of the map
+        are used, a layer larger than the map has no patches outside of the map.
+        :param group: group of the map
+        :param coverage: numpy array (rows x cols of patches) with the pixels with data of the layer
+        :return: list of (row, col) of the patches with data
+        """
+        shape = group['map'].shape
+        rows = math.ceil(shape[0] / self.tile_size)
+        cols = math.ceil(shape[1] / self.tile_size)
+        return [(int(x), int(y)) for x, y in np.argwhere(coverage[:rows, :cols])]
+
+    def _fit_grid(self, grid, shape, dtype):
+        """
+        Helper function to fit the counts of a layer to the grid of the map, a layer with a
+        different size than the map is cropped, or padded with 0.
+        :param grid: numpy array (rows x cols) with the counts of the layer
+        :param shape: rows and cols of the grid of the map
+        :param dtype: type of the result
+        :return: numpy array (rows x cols of the map)
+        """
+        result = np.zeros(shape, dtype=dtype)
+        rows, cols = min(shape[0], grid.shape[0]), min(shape[1], grid.shape[1])
+        result[:rows, :cols] = grid[:rows, :cols]
+        return result
+
+    def _add_cell_counts(self, cells, mask, row):
+        """
+        Helper function to add the pixels with data in a window of rows of an image to the
+        counts of the cells, the window does not need to start at a cell boundary.
+        :param cells: numpy array (rows x cols of cells) with the counts of the image
+        :param mask: boolean numpy array with the pixels with data in the window
+        :param row: first row of the window in the image
+        """
+        counts = np.add.reduceat(mask.view(np.uint8), np.arange(0, mask.shape[1], CELL_SIZE), axis=1,
+                                 dtype=np.uint16)
+        starts = np.unique(np.concatenate(([0], np.arange(-row % CELL_SIZE, mask.shape[0], CELL_SIZE))))
+        cells[(row + starts) // CELL_SIZE] += np.add.reduceat(counts, starts, axis=0, dtype=np.uint16)
+
+    def _cells_to_patches(self, cells, shape):
+        """
+        Helper function to compute the pixels with data in every patch from the counts of the
+        cells. Every cell that overlaps the patch (including the border) is counted, so this is
+        exact if the tile size and border are multiples of CELL_SIZE, and more than the pixels
+        in the patch otherwise. The result is at most the number of pixels of a patch.
+        :param cells: numpy array (layers x rows x cols of cells) with the counts of the cells
+        :param shape: shape of the image
+        :return: numpy array (layers x rows x cols of patches, uint32) with the pixels with data
+        """
+        counts = cells
+        for axis, size in ((1, shape[0]), (2, shape[1])):
+            count = math.ceil(size / self.tile_size)
+            starts = np.clip(np.arange(count) * self.tile_size - self.patch_border, 0, size) // CELL_SIZE
+            ends = -(-np.clip(np.arange(count) * self.tile_size + self.tile_size + self.patch_border, 0, size)
+                     // CELL_SIZE)
+            total = np.insert(np.cumsum(counts, axis=axis, dtype=np.uint64), 0, 0, axis=axis)
+            counts = np.take(total, ends, axis=axis) - np.take(total, starts, axis=axis)
+        return np.minimum(counts, self.patch_size * self.patch_size).astype(np.uint32)
+
+    def _read_image(self, filename, coverage=False):
+        """
+        Helper function to read an image from disk. This does not use the HDF5 file, so it
+        can run in a worker thread while other images are written.
         :param filename: image on disk
-        :param name: name of image in hdf5 file
-        :param group: parent folder of image
-        :return: dataset of image loaded (numpy array)
+        :param coverage: count the pixels with data in each patch and cell of the image
+        :return: image as numpy array, profile of the image and the counts of the patches and
+                 cells (None if not computed, see _count_pixels), or None if the file does not exist
         """
         if not os.path.exists(filename):
             print("File not found", filename)
             return None
         with rasterio.open(filename) as src:
             image = src.read()
-            if len(image.shape) == 3:
-                if image.shape[0] == 1:
-                    image = image[0]
-                elif image.shape[0] == 3:
-                    image = image.transpose(1, 2, 0)
-            dset = group.create_dataset(name=name, data=image, shape=image.shape, compression=self.compression)
-            dset.attrs.create('CLASS', 'IMAGE', dtype='S6')
-            dset.attrs.create('IMAGE_VERSION', '1.2', dtype='S4')
-            dset.attrs.create('INTERLACE_MODE', 'INTERLACE_PIXEL', dtype='S16')
-            dset.attrs.create('IMAGE_MINMAXRANGE', [0, 255], dtype=np.uint8)
-            if len(image.shape) == 3 and image.shape[2] == 3:
-                dset.attrs.create('IMAGE_SUBCLASS', 'IMAGE_TRUECOLOR', dtype='S16')
-            elif len(image.shape) == 2 or image.shape[2] == 1:
-                dset.attrs.create('IMAGE_SUBCLASS', 'IMAGE_GRAYSCALE', dtype='S15')
+            profile = src.profile
+        if len(image.shape) == 3:
+            if image.shape[0] == 1:
+                image = image[0]
+            elif image.shape[0] == 3:
+                image = image.transpose(1, 2, 0)
+        if coverage:
+            return image, profile, self._count_pixels(image)
+        return image, profile, None
+
+    def _write_image(self, image, profile, name, group):
+        """
+        Helper function to write an image to the file
+        :param image: image as numpy array
+        :param profile: rasterio profile of the image, used for the crs and transform
+        :param name: name of image in hdf5 file
+        :param group: parent folder of image
+        :return: dataset of image written
+        """
+        if self.pack_masks and image.ndim == 2 and image.dtype == np.uint8 and image.max() <= 1:
+            # binary mask, store 8 pixels per byte along the rows
+            chunks = self._chunk_shape(image.shape)
+            if isinstance(chunks, tuple):
+                chunks = (chunks[0], math.ceil(chunks[1] / 8))
+            data = np.packbits(image, axis=1)
+            dset = self._create_dataset(group, name, data, chunks, 'packed')
+            dset.attrs.create('PACKED_WIDTH', image.shape[1], dtype=np.uint32)
+        else:
+            kind = 'map' if name == 'map' else 'layer'
+            dset = self._create_dataset(group, name, image, self._chunk_shape(image.shape), kind)
+        self._set_image_attrs(dset, profile)
+        return dset
+
+    def _create_dataset(self, group, name, data, chunks, kind):
+        """
+        Helper function to create a dataset with the data. If sparse, only the chunks
+        that have data are written.
+        :param group: parent folder of the dataset
+        :param name: name of the dataset
+        :param data: data as numpy array
+        :param chunks: chunks of the dataset
+        :param kind: kind of dataset, used to select the codec (see _select_codec)
+        :return: dataset created
+        """
+        codec = self._select_codec(kind, lambda: data, chunks)
+        if not self.sparse:
+            dset = group.create_dataset(name=name, data=data, shape=data.shape, chunks=chunks, **_codec_args(codec))
+        else:
+            dset = group.create_dataset(name=name, shape=data.shape, dtype=data.dtype, chunks=chunks, fillvalue=0,
+                                        **_codec_args(codec))
+            self._write_sparse(dset, data, 0)
+        self._set_codec(dset, codec)
+        return dset
+
+    def _set_codec(self, dset, codec):
+        """
+        Helper function to store the codec of a dataset, so readers can tell which codec
+        is needed to read it.
+        :param dset: the dataset
+        :param codec: name of the codec, None for no compression
+        """
+        txt = codec or 'none'
+        dset.attrs.create('COMPRESSION', txt, dtype=f'S{len(txt)}')
+
+    def _chunk_occupancy(self, data, rows, cols):
+        """
+        Helper function to find the chunks of data that are not all 0.
+        :param data: data as numpy array
+        :param rows: rows of a chunk
+        :param cols: columns of a chunk
+        :return: boolean numpy array with for each chunk True if it has data
+        """
+        mask = data != 0
+        if mask.ndim == 3:
+            mask = mask.any(axis=2)
+        mask = np.logical_or.reduceat(mask, np.arange(0, mask.shape[0], rows), axis=0)
+        return np.logical_or.reduceat(mask, np.arange(0, mask.shape[1], cols), axis=1)
+
+    def _write_sparse(self, dset, data, row):
+        """
+        Helper function to write data to a dataset, skipping chunks that are all 0. The
+        data has to start at the beginning of a chunk.
+        :param dset: dataset to write to
+        :param data: data as numpy array
+        :param row: first row of the dataset to write the data to
+        """
+        if not dset.chunks:
+            dset[row:row + data.shape[0]] = data
+            return
+        rows, cols = dset.chunks[:2]
+        for x, y in np.argwhere(self._chunk_occupancy(data, rows, cols)):
+            block = data[x * rows:(x + 1) * rows, y * cols:(y + 1) * cols]
+            dset[row + x * rows:row + x * rows + block.shape[0], y * cols:y * cols + block.shape[1]] = block
+
+    def _set_image_attrs(self, dset, profile):
+        """
+        Helper function to set the image attributes of a dataset
+        :param dset: dataset of the image
+        :param profile: rasterio profile of the image, used for the crs and transform
+        """
+        dset.attrs.create('CLASS', 'IMAGE', dtype='S6')
+        dset.attrs.create('IMAGE_VERSION', '1.2', dtype='S4')
+        dset.attrs.create('INTERLACE_MODE', 'INTERLACE_PIXEL', dtype='S16')
+        dset.attrs.create('IMAGE_MINMAXRANGE', [0, 255], dtype=np.uint8)
+        if len(dset.shape) == 3 and dset.shape[2] == 3:
+            dset.attrs.create('IMAGE_SUBCLASS', 'IMAGE_TRUECOLOR', dtype='S16')
+        elif len(dset.shape) == 2 or dset.shape[2] == 1:
+            dset.attrs.create('IMAGE_SUBCLASS', 'IMAGE_GRAYSCALE', dtype='S15')
+        else:
+            raise Exception("Unknown image type")
+        if profile.get('crs'):
+            txt = profile['crs'].to_string()
+            dset.attrs.create('CRS', txt, dtype=f'S{len(txt)}')
+        if profile.get('transform'):
+            txt = affine.dumpsw(profile['transform'])
+            dset.attrs.create('TRANSFORM', txt, dtype=f'S{len(txt)}')
+
+    def _stream_image(self, filename, name, group, coverage=False):
+        """
+        Helper function to add an image to the file without reading the whole image in
+        memory. The image is read in windows of rows aligned to the chunks of the dataset,
+        at most max_window_bytes large, and the pixels with data are counted per window.
+        :param filename: image on disk
+        :param name: name of image in hdf5 file
+        :param group: parent folder of image
+        :param coverage: count the pixels with data in each patch and cell of the image
+        :return: dataset of image loaded and the counts of the patches and cells (None if not
+                 computed, see _count_pixels)
+        """
+        with rasterio.open(filename) as src:
+            if src.count == 1:
+                shape = (src.height, src.width)
+            elif src.count == 3:
+                shape = (src.height, src.width, 3)
             else:
                 raise Exception("Unknown image type")
-            if src.profile.get('crs'):
-                txt = src.profile['crs'].to_string()
-                dset.attrs.create('CRS', txt, dtype=f'S{len(txt)}')
-            if src.profile.get('transform'):
-                txt = affine.dumpsw(src.profile['transform'])
-                dset.attrs.create('TRANSFORM', txt, dtype=f'S{len(txt)}')
-            return dset
-        return None
+            chunks = self._chunk_shape(shape)
+            row_bytes = src.width * src.count * np.dtype(src.dtypes[0]).itemsize
+
+            def sample():
+                # rows of chunks from the middle of the image, used to pick the codec for "auto"
+                rows = chunks[0] if isinstance(chunks, tuple) else self.tile_size
+                rows = max(1, self.max_window_bytes // (row_bytes * rows)) * rows
+                row = max(0, (src.height - rows) // 2)
+                image = src.read(window=rasterio.windows.Window(0, row, src.width, min(rows, src.height - row)))
+                return image[0] if src.count == 1 else image.transpose(1, 2, 0)
+
+            codec = self._select_codec('map' if name == 'map' else 'layer', sample, chunks)
+            dset = group.create_dataset(name=name, shape=shape, dtype=src.dtypes[0], chunks=chunks, fillvalue=0,
+                                        **_codec_args(codec))
+            self._set_codec(dset, codec)
+            self._set_image_attrs(dset, src.profile)
+            chunk_rows = dset.chunks[0] if dset.chunks else 1
+            window_rows = max(1, self.max_window_bytes // (row_bytes * chunk_rows)) * chunk_rows
+            # pixels with data in the patch columns for every row of the image, the patch size is
+            # stored as uint16 so the count of a row fits in uint16
+            rows = np.zeros((src.height, self._patch_count(src.width)), dtype=np.uint16) if coverage else None
+            cells = np.zeros(self._cell_shape(shape), dtype=np.uint16) if coverage else None
+            for row in range(0, src.height, window_rows):
+                window = rasterio.windows.Window(0, row, src.width, min(window_rows, src.height - row))
+                image = src.read(window=window)
+                if src.count == 1:
+                    image = image[0]
+                else:
+                    image = image.transpose(1, 2, 0)
+                if self.sparse:
+                    self._write_sparse(dset, image, row)
+                else:
+                    dset[row:row + image.shape[0]] = image
+                if coverage:
+                    mask = image != 0
+                    if mask.ndim == 3:
+                        mask = mask.any(axis=2)
+                    rows[row:row + image.shape[0]] = self._reduce_patches(mask, 1)
+                    self._add_cell_counts(cells, mask, row)
+        if coverage:
+            return dset, (self._reduce_patches(rows, 0).astype(np.uint32), cells)
+        return dset, None
+
+    def _add_image(self, filename, name, group, coverage=False):
+        """
+        Helper function to add an image to the file
+        :param filename: image on disk
+        :param name: name of image in hdf5 file
+        :param group: parent folder of image
+        :param coverage: count the pixels with data in each patch and cell of the image
+        :return: dataset of image loaded and the counts of the patches and cells (None if not
+                 computed, see _count_pixels)
+        """
+        if self.max_window_bytes and os.path.exists(filename):
+            return self._stream_image(filename, name, group, coverage)
+        data = self._read_image(filename, coverage)
+        if data is None:
+            return None, None
+        image, profile, counts = data
+        return self._write_image(image, profile, name, group), counts
+
+    def _add_overviews(self, group, name):
+        """
+        Helper function to write the overview levels of an image in _overviews/<level>/<name>.
+        Each level is computed from the previous level in windows of rows (at most
+        max_window_bytes, or 64MB, of the previous level), so the image is never read
+        completely in memory.
+        :param group: group of the map
+        :param name: name of the image
+        """
+        kind = 'map' if name == 'map' else 'layer'
+        mapname = group.name[1:]
+        src = group[name]
+        for level in range(1, self.overviews + 1):
+            width = self._packed_width(src) or src.shape[1]
+            shape = ((src.shape[0] + 1) // 2, (width + 1) // 2) + src.shape[2:]
+            row_bytes = width * (src.shape[2] if src.ndim == 3 else 1)
+            chunks = self._chunk_shape(shape)
+            chunk_rows = chunks[0] if isinstance(chunks, tuple) else self.tile_size
+            window_rows = max(1, (self.max_window_bytes or 2**26) // (2 * row_bytes * chunk_rows)) * chunk_rows
+
+            def read(row):
+                rows = min(2 * window_rows, src.shape[0] - 2 * row)
+                return self._downsample(self._read_window(src, 2 * row, 0, rows, width), kind)
+
+            codec = self._select_codec(kind, lambda: read(0), chunks)
+            dset = group.require_group(f"_overviews/{level}").create_dataset(
+                name, shape=shape, dtype=np.uint8, chunks=chunks, fillvalue=0, **_codec_args(codec))
+            self._set_codec(dset, codec)
+            transform = self.get_transform(mapname, name)
+            self._set_image_attrs(dset, {'crs': self.get_crs(mapname, name),
+                                         'transform': transform * affine.Affine.scale(2 ** level) if transform else None})
+            # align the windows to the chunks of the dataset, needed to write sparse
+            chunk_rows = dset.chunks[0] if dset.chunks else 1
+            window_rows = max(1, (self.max_window_bytes or 2**26) // (2 * row_bytes * chunk_rows)) * chunk_rows
+            for row in range(0, shape[0], window_rows):
+                image = read(row)
+                if self.sparse:
+                    self._write_sparse(dset, image, row)
+                else:
+                    dset[row:row + image.shape[0]] = image
+            src = dset
+
+    def _downsample(self, image, kind):
+        """
+        Helper function to make an image half the size, odd rows and columns are repeated.
+        :param image: image as numpy array
+        :param kind: "map" to use the average of 2x2 pixels, otherwise the maximum is used
+        :return: image as numpy array
+        """
+        if image.shape[0] % 2 or image.shape[1] % 2:
+            pad = ((0, image.shape[0] % 2), (0, image.shape[1] % 2)) + ((0, 0),) * (image.ndim - 2)
+            image = np.pad(image, pad, mode='edge')
+        blocks = image.reshape((image.shape[0] // 2, 2, image.shape[1] // 2, 2) + image.shape[2:])
+        if kind == 'map':
+            return ((blocks.sum(axis=(1, 3), dtype=np.uint16) + 2) // 4).astype(image.dtype)
+        return blocks.max(axis=(1, 3))
+
+    def _add_patch_index(self, group, layer, counts):
+        """
+        Helper function to add the coverage of a layer to the patch index of the map. The
+        index has a boolean dataset occupancy and a uint32 dataset coverage with the pixels
+        with data (both layers x rows x cols of patches), a uint16 dataset cells with the
+        pixels with data in each cell (layers x rows x cols of cells), with a table of the
+        layer names.
+        :param group: group of the map
+        :param layer: the name of the layer
+        :param counts: the pixels with data in each patch and each cell, see _count_pixels
+        """
+        coverage, cells = counts
+        shape = group['map'].shape
+        rows = math.ceil(shape[0] / self.tile_size)
+        cols = math.ceil(shape[1] / self.tile_size)
+        if '_index' not in group:
+            index = group.create_group('_index')
+            index.create_dataset('layers', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+            self._create_index_dataset(index, 'occupancy', rows, cols, bool)
+        index = group['_index']
+        if 'coverage' not in index or 'cells' not in index:
+            self._add_index_counts(group)
+        n = index['layers'].shape[0]
+        index['layers'].resize((n + 1,))
+        index['layers'][n] = layer
+        grid = self._fit_grid(coverage, (rows, cols), np.uint32)
+        index['occupancy'].resize(n + 1, axis=0)
+        index['occupancy'][n] = grid > 0
+        index['coverage'].resize(n + 1, axis=0)
+        index['coverage'][n] = grid
+        index['cells'].resize(n + 1, axis=0)
+        index['cells'][n] = self._fit_grid(cells, self._cell_shape(shape), np.uint16)
+
+    def _add_index_counts(self, group):
+        """
+        Helper function to add the coverage and cells to a patch index written before they
+        were stored, the pixels of the layers in the index are counted again.
+        :param group: group of the map
+        """
+        index = group['_index']
+        n, rows, cols = index['occupancy'].shape
+        missing = [name for name in ('coverage', 'cells') if name not in index]
+        if 'coverage' in missing:
+            self._create_index_dataset(index, 'coverage', rows, cols, np.uint32)
+        if 'cells' in missing:
+            self._create_index_dataset(index, 'cells', *self._cell_shape(group['map'].shape), np.uint16)
+            index['cells'].attrs.create('CELL_SIZE', CELL_SIZE, dtype=np.uint16)
+        for name in missing:
+            index[name].resize(n, axis=0)
+        for i, name in enumerate(index['layers'].asstr()[...]):
+            coverage, cells = self._count_pixels(self._read_full(group[name]))
+            if 'coverage' in missing:
+                index['coverage'][i] = self._fit_grid(coverage, (rows, cols), np.uint32)
+            if 'cells' in missing:
+                index['cells'][i] = self._fit_grid(cells, self._cell_shape(group['map'].shape), np.uint16)
+
+    def _create_index_dataset(self, index, name, rows, cols, dtype):
+        """
+        Helper function to create a dataset (layers x rows x cols) in the patch index.
+        :param index: group of the patch index
+        :param name: name of the dataset
+        :param rows: rows of patches (or cells) in the map
+        :param cols: columns of patches (or cells) in the map
+        :param dtype: type of the dataset
+        """
+        codec = self._select_codec('index')
+        dset = index.create_dataset(name, shape=(0, rows, cols), maxshape=(None, rows, cols),
+                                    chunks=(1, rows, cols), dtype=dtype, **_codec_args(codec))
+        self._set_codec(dset, codec)
+
+    def _is_empty_patch(self, mapname, layer, row, col):
+        """
+        Helper function to check, using the patch index, if a layer has no data in a patch.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :return: True if the patch index shows the layer has no data in the patch
+        """
+        if layer == 'map':
+            return False
+        index = self._get_patch_index(mapname)
+        if not index or layer not in index[0]:
+            return False
+        occupancy = index[1]
+        if row >= occupancy.shape[1] or col >= occupancy.shape[2]:
+            return False
+        return not occupancy[index[0].index(layer), row, col]
+
+    def _get_patch_index(self, mapname):
+        """
+        Helper function to get the patch index of a map.
+        :param mapname: the name of the map
+        :return: list of layer names and occupancy array, None if the map has no index
+        """
+        def loader():
+            if self._retiled:
+                layers, coverage = self._get_coverage(mapname)
+                return layers, coverage > 0
+            if '_index' not in self.h5f[mapname]:
+                return None
+            index = self.h5f[mapname]['_index']
+            return list(index['layers'].asstr()[...]), index['occupancy'][...]
+        return self._get_metadata(mapname, 'index', loader)
+
+    def _get_coverage(self, mapname):
+        """
+        Helper function to get the coverage of the patches of all layers of a map. If the
+        file is retiled the coverage is computed from the cells.
+        :param mapname: the name of the map
+        :return: list of layer names and coverage array, None if the map has no coverage
+        """
+        def loader():
+            group = self.h5f[mapname]
+            if self._retiled:
+                if '_index' not in group or 'cells' not in group['_index']:
+                    raise ValueError(f"No cells stored for {mapname}, needed to retile, use upgrade to add them")
+                index = group['_index']
+                cells = index['cells'][...]
+                if int(index['cells'].attrs.get('CELL_SIZE', CELL_SIZE)) != CELL_SIZE:
+                    raise ValueError(f"Cells of {mapname} are not {CELL_SIZE} pixels")
+                return list(index['layers'].asstr()[...]), self._cells_to_patches(cells, group['map'].shape)
+            if '_index' not in group or 'coverage' not in group['_index']:
+                return None
+            index = group['_index']
+            return list(index['layers'].asstr()[...]), index['coverage'][...]
+        return self._get_metadata(mapname, 'coverage', loader)
+
+    def _update_patches(self, group, all_patches, layers_patch):
+        """
+        Helper function to store the patches of all layers in the group of the map.
+        :param group: group of the map
+        :param all_patches: for each layer a list of patches
+        :param layers_patch: for each patch (x_y) a list of layers
+        """
+        valid_patches = [[int(k.split('_')[0]), int(k.split('_')[1])] for k in layers_patch.keys()]
+        if valid_patches:
+            r1 = min(valid_patches, key=lambda value: int(value[0]))[0]
+            r2 = max(valid_patches, key=lambda value: int(value[0]))[0]
+            c1 = min(valid_patches, key=lambda value: int(value[1]))[1]
+            c2 = max(valid_patches, key=lambda value: int(value[1]))[1]
+            group.attrs.update({'corners': [[r1, c1], [r2, c2]]})
+        group.attrs.update({'patches': json.dumps(all_patches)})
+        group.attrs.update({'layers_patch': json.dumps(layers_patch)})
+        group.attrs.update({'valid_patches': json.dumps(valid_patches)})
+
+    def add_legends(self, mapname, layers=None):
+        """
+        Store the legends of the map in the file, each legend is cropped from the map once and
+        stored in the _legends group with its bounds, so get_legend does not need to read the
+        map. Legends already stored are not changed. This is done when adding an image, and
+        can be used to add the legends to files written before the legends were stored.
+        :param mapname: the name of the map
+        :param layers: list of layer names, if None the legends of all labels in the json are stored
+        """
+        if self.mode == 'r':
+            raise Exception("Cannot add legends to read-only file")
+        legends = self.h5f[mapname].require_group('_legends')
+        for label, bounds in self._get_legend_bounds(mapname).items():
+            if label in legends or (layers is not None and label not in layers):
+                continue
+            dset = legends.create_dataset(label, data=self._crop_legend(mapname, bounds))
+            dset.attrs.create('BOUNDS', bounds, dtype=np.int32)
+
+    def upgrade(self, mapname=None):
+        """
+        Add the structures of newer versions to maps written by older versions: the patch
+        index with the coverage of the patches (if patch_index is set) and the legends.
+        :param mapname: the name of the map, if None all maps are upgraded
+        """
+        if self.mode == 'r':
+            raise Exception("Cannot upgrade read-only file")
+        for name in ([mapname] if mapname else self.get_maps()):
+            self._invalidate_metadata(name)
+            group = self.h5f[name]
+            if self.patch_index:
+                if '_index' not in group:
+                    self._index_layers(group)
+                elif 'coverage' not in group['_index'] or 'cells' not in group['_index']:
+                    self._add_index_counts(group)
+            self.add_legends(name)
+
+    def _index_layers(self, group):
+        """
+        Helper function to add the layers, added before the patch index existed, to the index.
+        :param group: group of the map
+        """
+        for layer in json.loads(group.attrs.get('patches', '{}')):
+            self._add_patch_index(group, layer, self._count_pixels(self._read_full(group[layer])))
 
     def add_layer(self, mapname, layername, filename):
         """
@@ -178,51 +1259,47 @@ class H5Image:
         if not os.path.exists(filename):
             raise Exception("Image file not found")
 
-        # get the map and compute the number of patches
-        dset = self.get_layer(mapname, "map")
-        w = math.ceil(dset.shape[0] / self.tile_size)
-        h = math.ceil(dset.shape[1] / self.tile_size)
-
         # load the image and add it to the group
+        self._invalidate_metadata(mapname)
         group = self.h5f[mapname]
         all_patches = json.loads(group.attrs.get('patches', '{}'))
-        layers_patch = json.loads(group.attrs.get('layers_patch', {}))
-        patches = []
-        dset = self._add_image(filename, layername, group)
+        layers_patch = json.loads(group.attrs.get('layers_patch', '{}'))
+        if self.patch_index and '_index' not in group:
+            self._index_layers(group)
+        dset, counts = self._add_image(filename, layername, group, coverage=True)
+        if dset and '_legends' in group:
+            self.add_legends(mapname, [layername])
+        if dset and self.overviews:
+            self._add_overviews(group, layername)
         if dset:
-            for x in range(w):
-                for y in range(h):
-                    rgb = self._crop_image(dset, x, y)
-                    if np.average(rgb, axis=(0, 1)) > 0:
-                        patches.append((x, y))
-                        layers_patch.setdefault(f"{x}_{y}", []).append(layername)
+            patches = self._layer_patches(group, counts[0])
+            # an existing index is always kept up to date, since the getters use it when it exists
+            if '_index' in group:
+                self._add_patch_index(group, layername, counts)
+            for x, y in patches:
+                layers_patch.setdefault(f"{x}_{y}", []).append(layername)
             dset.attrs.update({'patches': json.dumps(patches)})
             all_patches[layername] = patches
         else:
             raise ValueError("Error loading layer {filename}")
 
         # update the group
-        valid_patches = [[int(k.split('_')[0]), int(k.split('_')[1])] for k in layers_patch.keys()]
-        if valid_patches:
-            r1 = min(valid_patches, key=lambda value: int(value[0]))[0]
-            r2 = max(valid_patches, key=lambda value: int(value[0]))[0]
-            c1 = min(valid_patches, key=lambda value: int(value[1]))[1]
-            c2 = max(valid_patches, key=lambda value: int(value[1]))[1]
-            group.attrs.update({'corners': [[r1, c1], [r2, c2]]})
-        group.attrs.update({'patches': json.dumps(all_patches)})
-        group.attrs.update({'layers_patch': json.dumps(layers_patch)})
-        group.attrs.update({'valid_patches': json.dumps(valid_patches)})
+        self._update_patches(group, all_patches, layers_patch)
 
     # add an image to the file
-    def add_image(self, filename, folder="", mapname=""):
+    def add_image(self, filename, folder="", mapname="", workers=1):
         """
         Add a set of images to the file. The filenname is assumed to be json and is
         used to load all images with the same prefix. The map is assumed to have the
         same prefix as the json file (but ending with .tif). The json file lists all
         layers that are added as well. The json file is attached to the group.
+        If workers is more than 1, the layers are read and their patches computed in
+        worker threads, while the layers are written to the file one at a time. Workers
+        are not used if max_window_bytes is set, since each layer is streamed to the file.
         :param filename: the json file to load
         :param folder: directory where to find the json file
         :param mapname: the name of the map, if empty the name of the json file is used
+        :param workers: number of threads used to read the layers
         """
         # make sure file is writeable
         if self.mode == 'r':
@@ -251,43 +1328,57 @@ class H5Image:
             raise Exception("No shapes found")
 
         # create the group
+        self._invalidate_metadata(mapname)
         group = self.h5f.create_group(mapname)
         group.attrs.update({'json': json.dumps(json_data)})
 
-        # load image
-        dset = self._add_image(tiffile, "map", group)
-        w = math.ceil(dset.shape[0] / self.tile_size)
-        h = math.ceil(dset.shape[1] / self.tile_size)
+        # load image and store the legends
+        self._add_image(tiffile, "map", group)
+        self.add_legends(mapname)
+        if self.overviews:
+            self._add_overviews(group, "map")
+
+        # loop through shapes, reading ahead at most 2 layers per worker
+        labels = [shape['label'] for shape in json_data['shapes']]
+        executor = None
+        if workers > 1 and not self.max_window_bytes:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        futures = {}
+
+        def add_layer(i):
+            if executor is None:
+                return self._add_image(f"{prefix}_{labels[i]}.tif", labels[i], group, coverage=True)
+            for j in range(i, min(i + 2 * workers, len(labels))):
+                if j not in futures:
+                    futures[j] = executor.submit(self._read_image, f"{prefix}_{labels[j]}.tif", True)
+            data = futures.pop(i).result()
+            if data is None:
+                return None, None
+            image, profile, counts = data
+            return self._write_image(image, profile, labels[i], group), counts
 
-        # loop through shapes
         all_patches = {}
         layers_patch = {}
-        for shape in json_data['shapes']:
-            label = shape['label']
-            patches = []
-            try:
-                dset = self._add_image(f"{prefix}_{label}.tif", label, group)
-                if dset:
-                    for x in range(w):
-                        for y in range(h):
-                            rgb = self._crop_image(dset, x, y)
-                            if np.average(rgb, axis=(0, 1)) > 0:
-                                patches.append((x, y))
-                                layers_patch.setdefault(f"{x}_{y}", []).append(label)
-                    dset.attrs.update({'patches': json.dumps(patches)})
-                    all_patches[label] = patches
-            except ValueError as e:
-                logging.warning(f"Error loading {label} : {e}")
-        valid_patches = [[int(k.split('_')[0]), int(k.split('_')[1])] for k in layers_patch.keys()]
-        if valid_patches:
-            r1 = min(valid_patches, key=lambda value: int(value[0]))[0]
-            r2 = max(valid_patches, key=lambda value: int(value[0]))[0]
-            c1 = min(valid_patches, key=lambda value: int(value[1]))[1]
-            c2 = max(valid_patches, key=lambda value: int(value[1]))[1]
-            group.attrs.update({'corners': [[r1, c1], [r2, c2]]})
-        group.attrs.update({'patches': json.dumps(all_patches)})
-        group.attrs.update({'layers_patch': json.dumps(layers_patch)})
-        group.attrs.update({'valid_patches': json.dumps(valid_patches)})
+        try:
+            for i, label in enumerate(labels):
+                try:
+                    dset, counts = add_layer(i)
+                    if dset:
+                        patches = self._layer_patches(group, counts[0])
+                        if self.patch_index:
+                            self._add_patch_index(group, label, counts)
+                        if self.overviews:
+                            self._add_overviews(group, label)
+                        for x, y in patches:
+                            layers_patch.setdefault(f"{x}_{y}", []).append(label)
+                        dset.attrs.update({'patches': json.dumps(patches)})
+                        all_patches[label] = patches
+                except ValueError as e:
+                    logging.warning(f"Error loading {label} : {e}")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self._update_patches(group, all_patches, layers_patch)
 
     def save_image(self, mapname, destination, layer=None):
         """
@@ -302,7 +1393,7 @@ class H5Image:
             os.makedirs(destination)
         if layer is None:
             self.save_image(mapname, destination, "map")
-            json_data = json.loads(self.h5f[mapname].attrs['json'])
+            json_data = self._get_json(mapname)
             json.dump(json_data, open(os.path.join(destination, f"{mapname}.json"), "w"), indent=2)
             for layer in self.get_layers(mapname):
                 self.save_image(mapname, destination, layer)
@@ -311,7 +1402,7 @@ class H5Image:
             if dset.ndim == 3:
                 image = dset[...].transpose(2, 0, 1)  # rasterio expects bands first
             else:
-                image = np.array(dset[...], ndmin=3)
+                image = np.array(self._read_full(dset), ndmin=3)
             if layer == "map":
                 filename = os.path.join(destination, f"{mapname}.tif")
             else:
@@ -335,16 +1426,18 @@ class H5Image:
         :param mapname: the name of the map
         :return: image as numpy array
         """
-        return self.h5f[mapname]['map']
+        mapped = self._get_memmap(mapname, 'map')
+        return self.h5f[mapname]['map'] if mapped is None else mapped
 
     # return map size
-    def get_map_size(self, mapname):
+    def get_map_size(self, mapname, level=0):
         """
         Returns the size of the map.
         :param mapname: the name of the map
+        :param level: overview level, 0 for the full resolution
         :return: size of the map
         """
-        return self.h5f[mapname]['map'].shape
+        return self._get_dataset(mapname, 'map', level).shape
 
     def get_crs(self, mapname, layer='map'):
         """
@@ -353,9 +1446,11 @@ class H5Image:
         :param layer: the name of the layer, defaults to the map
         :return: crs of the map
         """
-        if 'CRS' in self.h5f[mapname][layer].attrs:
-            return rasterio.CRS.from_string(self.h5f[mapname][layer].attrs['CRS'].decode('utf-8'))
-        return None
+        def loader():
+            if 'CRS' in self.h5f[mapname][layer].attrs:
+                return rasterio.CRS.from_string(self.h5f[mapname][layer].attrs['CRS'].decode('utf-8'))
+            return None
+        return self._get_metadata(mapname, f"crs/{layer}", loader)
 
     def get_transform(self, mapname, layer='map'):
         """
@@ -364,9 +1459,11 @@ class H5Image:
         :param layer: the name of the layer, defaults to the map
         :return: transform of the map
         """
-        if 'TRANSFORM' in self.h5f[mapname][layer].attrs:
-            return affine.loadsw(self.h5f[mapname][layer].attrs['TRANSFORM'].decode('utf-8'))
-        return None
+        def loader():
+            if 'TRANSFORM' in self.h5f[mapname][layer].attrs:
+                return affine.loadsw(self.h5f[mapname][layer].attrs['TRANSFORM'].decode('utf-8'))
+            return None
+        return self._get_metadata(mapname, f"transform/{layer}", loader)
 
     def get_map_corners(self, mapname):
         """
@@ -374,6 +1471,9 @@ class H5Image:
         :param mapname: the name of the map
         :return: bounds of the map
         """
+        if self._retiled:
+            valid_patches = np.array(self._get_patches(mapname, 'valid_patches')).reshape(-1, 2)
+            return [valid_patches.min(axis=0), valid_patches.max(axis=0)]
         return list(self.h5f[mapname].attrs['corners'])
 
     # get list of all layers for map
@@ -383,9 +1483,7 @@ class H5Image:
         :param mapname: the name of the map
         :return: list of layer names
         """
-        layers = list(self.h5f[mapname].keys())
-        layers.remove('map')
-        return layers
+        return [k for k, v in self.h5f[mapname].items() if isinstance(v, h5py.Dataset) and k != 'map']
 
     def get_layer(self, mapname, layer):
         """
@@ -394,22 +1492,56 @@ class H5Image:
         :param layer: the name of the layer
         :return: image as numpy array
         """
-        return self.h5f[mapname][layer]
+        mapped = self._get_memmap(mapname, layer)
+        if mapped is not None:
+            return mapped
+        dset = self.h5f[mapname][layer]
+        if self._packed_width(dset) is not None:
+            return self._read_full(dset)
+        return dset
 
     def get_patches(self, mapname, by_location=False):
         """
         Returns a list of all patches for a map. The patches are grouped by layer. If by_location is
         False it returns a dict of layers, each with a list of patches (as arrays). If by location
         the result will be a dict of patches (col-row) , each with a list of layers.
-        patches for a map
+        patches for a map. The patches are cached, every call returns a new copy.
         :param mapname: the name of the map
         :param by_location: if True, return a dictionary with locations as keys and layers as values
         :return: list of patches
         """
         if by_location:
-            return json.loads(self.h5f[mapname].attrs['layers_patch'])
+            return {k: list(v) for k, v in self._get_patches(mapname, 'layers_patch').items()}
         else:
-            return json.loads(self.h5f[mapname].attrs['patches'])
+            return {k: [list(p) for p in v] for k, v in self._get_patches(mapname, 'patches').items()}
+
+    def _get_patches(self, mapname, key):
+        """
+        Helper function to get the cached patches of a map, the result should not be modified.
+        :param mapname: the name of the map
+        :param key: patches, layers_patch or valid_patches
+        :return: the patches as stored in the json attribute with the same name
+        """
+        return self._get_metadata(mapname, key, lambda: self._load_patches(mapname, key))
+
+    def _load_patches(self, mapname, key):
+        """
+        Helper function to load the patches of a map, from the patch index if it exists,
+        otherwise from the json attributes.
+        :param mapname: the name of the map
+        :param key: patches, layers_patch or valid_patches
+        :return: the patches as stored in the json attribute with the same name
+        """
+        index = self._get_patch_index(mapname)
+        if not index:
+            return json.loads(self.h5f[mapname].attrs[key])
+        layers, occupancy = index
+        patches = {layer: np.argwhere(occupancy[i]).tolist() for i, layer in enumerate(layers)}
+        if key == 'patches':
+            return patches
+        if key == 'layers_patch':
+            return patches_by_location(patches)
+        return valid_patches(patches)
 
     def get_valid_patches(self, mapname):
         """
@@ -418,15 +1550,24 @@ class H5Image:
         :param mapname: the name of the map
         :return: list of valid patches
         """
-        return json.loads(self.h5f[mapname].attrs['valid_patches'])
+        return [list(p) for p in self._get_patches(mapname, 'valid_patches')]
 
-    def get_patches_for_layer(self, mapname, layer):
+    def get_patches_for_layer(self, mapname, layer, min_coverage=None):
         """
-        Returns a list of all patches for a layer.
+        Returns a list of all patches for a layer. If min_coverage is given, only the patches
+        where at least this fraction of the pixels of the patch (including the border) have
+        data are returned, this needs the coverage stored in the patch index.
         :param mapname: the name of the map
         :param layer: the name of the layer
+        :param min_coverage: minimum fraction (0 - 1) of pixels of a patch with data
         :return: list of patches
         """
+        if min_coverage is not None:
+            coverage = self.get_patch_coverage(mapname, layer)
+            return np.argwhere((coverage > 0) & (coverage >= min_coverage)).tolist()
+        index = self._get_patch_index(mapname)
+        if index and layer in index[0]:
+            return np.argwhere(index[1][index[0].index(layer)]).tolist()
         return json.loads(self.h5f[mapname][layer].attrs['patches'])
 
     def get_layers_for_patch(self, mapname, row, col):
@@ -437,53 +1578,319 @@ class H5Image:
         :param col: the column of the patch
         :return: list of layers
         """
-        return json.loads(self.h5f[mapname].attrs['layers_patch']).get(f"{row}_{col}", [])
+        index = self._get_patch_index(mapname)
+        if index:
+            layers, occupancy = index
+            if row < 0 or col < 0 or row >= occupancy.shape[1] or col >= occupancy.shape[2]:
+                return []
+            return [layer for layer, found in zip(layers, occupancy[:, row, col]) if found]
+        return list(self._get_patches(mapname, 'layers_patch').get(f"{row}_{col}", []))
+
+    def get_patch_coverage(self, mapname, layer):
+        """
+        Returns for each patch the fraction of the pixels of the patch (including the border)
+        where the layer has data. This is read from the patch index, no image data is read.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :return: numpy array (rows x cols of patches) with the coverage of each patch
+        """
+        coverage = self._get_coverage(mapname)
+        if not coverage:
+            raise ValueError(f"No coverage stored for {mapname}")
+        layers, counts = coverage
+        if layer not in layers:
+            raise ValueError(f"No coverage stored for {layer} of {mapname}")
+        return counts[layers.index(layer)] / float(self.patch_size * self.patch_size)
+
+    def get_top_patches(self, mapname, layer, count=10):
+        """
+        Returns the patches where the layer has the highest coverage, see get_patch_coverage.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param count: number of patches to return
+        :return: list of (row, col, coverage), sorted by coverage, highest first
+        """
+        coverage = self.get_patch_coverage(mapname, layer)
+        order = np.argsort(-coverage, axis=None, kind='stable')[:count]
+        return [(int(row), int(col), float(coverage[row, col]))
+                for row, col in zip(*np.unravel_index(order, coverage.shape)) if coverage[row, col] > 0]
 
     # get legend from map
     def get_legend(self, mapname, layer):
         """
-        Returns the cropped image of the legend in the map.
+        Returns the cropped image of the legend in the map. If the legends are stored in the
+        file (see add_legends) the stored legend is returned, otherwise it is cropped from
+        the map.
         :param mapname: the name of the map
         :param layer: the name of the layer
         :return: cropped image of legend
         """
-        json_data = json.loads(self.h5f[mapname].attrs['json'])
-        for shape in json_data['shapes']:
-            if shape['label'] == layer:
-                points = shape['points']
-                y, x = zip(*points)
-                x1 = int(min(x))
-                x2 = int(max(x))
-                y1 = int(min(y))
-                y2 = int(max(y))
-                w = abs(x2 - x1)
-                h = abs(y2 - y1)
-                # points in array are floats
-                src = np.s_[int(x1):int(x2), int(y1):int(y2)]
-                dset = self.h5f[mapname]['map']
-                if len(dset.shape) == 3 and dset.shape[2] == 3:
-                    rgb = np.zeros((w, h, 3), dtype=np.uint8)
-                else:
-                    rgb = np.zeros((w, h), dtype=np.uint8)
-                try:
-                    dset.read_direct(rgb, src)
-                except TypeError as e:
-                    logging.warn(f"{x1}, {x2}, {y1}, {y2}")
-                    logging.error(f"Error reading legend {dset.name} : {e}")
-                return rgb
-        return None
+        group = self.h5f[mapname]
+        if '_legends' in group and layer in group['_legends']:
+            return group['_legends'][layer][...]
+        bounds = self._get_legend_bounds(mapname).get(layer)
+        if bounds is None:
+            return None
+        return self._crop_legend(mapname, bounds)
+
+    def get_legends(self, mapname, layers=None):
+        """
+        Returns the cropped images of the legends of many layers.
+        :param mapname: the name of the map
+        :param layers: list of layer names, if None all layers of the map are used
+        :return: dict with for each layer the cropped image of the legend
+        """
+        if layers is None:
+            layers = self.get_layers(mapname)
+        return {layer: self.get_legend(mapname, layer) for layer in layers}
+
+    def _crop_legend(self, mapname, bounds):
+        """
+        Helper function to crop a legend from the map.
+        :param mapname: the name of the map
+        :param bounds: bounds of the legend (x1, x2, y1, y2)
+        :return: cropped image of legend
+        """
+        x1, x2, y1, y2 = bounds
+        w = abs(x2 - x1)
+        h = abs(y2 - y1)
+        src = np.s_[x1:x2, y1:y2]
+        dset = self.h5f[mapname]['map']
+        if len(dset.shape) == 3 and dset.shape[2] == 3:
+            rgb = np.zeros((w, h, 3), dtype=np.uint8)
+        else:
+            rgb = np.zeros((w, h), dtype=np.uint8)
+        try:
+            dset.read_direct(rgb, src)
+        except TypeError as e:
+            logging.warn(f"{x1}, {x2}, {y1}, {y2}")
+            logging.error(f"Error reading legend {dset.name} : {e}")
+        return rgb
+
+    def _get_dataset(self, mapname, layer, level=0):
+        """
+        Helper function to get the dataset of an image, or of an overview level of the image.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param level: overview level, 0 for the image itself
+        :return: dataset of the image
+        """
+        if level == 0:
+            return self.h5f[mapname][layer]
+        group = self.h5f[mapname]
+        if '_overviews' not in group or str(level) not in group['_overviews'] \
+                or layer not in group['_overviews'][str(level)]:
+            raise ValueError(f"No overview level {level} for {layer} of {mapname}")
+        return group['_overviews'][str(level)][layer]
+
+    def get_overview_levels(self, mapname):
+        """
+        Returns the number of overview levels of a map.
+        :param mapname: the name of the map
+        :return: number of overview levels, 0 if the map has no overviews
+        """
+        group = self.h5f[mapname]
+        if '_overviews' not in group:
+            return 0
+        return len(group['_overviews'])
+
+    def get_bounds(self, mapname, crs=None, layer='map'):
+        """
+        Returns the bounds of the map or a layer, computed from the stored transform.
+        :param mapname: the name of the map
+        :param crs: crs to return the bounds in, None for the crs of the map
+        :param layer: the name of the layer, defaults to the map
+        :return: (left, bottom, right, top)
+        """
+        transform = self._get_geo_transform(mapname, layer)
+        dset = self._get_dataset(mapname, layer)
+        height, width = dset.shape[0], self._packed_width(dset) or dset.shape[1]
+        xs, ys = zip(*[transform * corner for corner in [(0, 0), (width, height)]])
+        bounds = (min(xs), min(ys), max(xs), max(ys))
+        if crs is None:
+            return bounds
+        return transform_bounds(bounds, self._get_geo_crs(mapname, layer), crs)
+
+    def _get_geo_transform(self, mapname, layer):
+        """
+        Helper function to get the transform of an image, raising an error if it is not known.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :return: transform of the image
+        """
+        transform = self.get_transform(mapname, layer)
+        if transform is None:
+            raise ValueError(f"No transform stored for {layer} of {mapname}")
+        return transform
+
+    def _get_geo_crs(self, mapname, layer):
+        """
+        Helper function to get the crs of an image, raising an error if it is not known.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :return: crs of the image
+        """
+        crs = self.get_crs(mapname, layer)
+        if crs is None:
+            raise ValueError(f"No crs stored for {layer} of {mapname}")
+        return crs
+
+    def _bounds_to_window(self, mapname, bounds, crs, layer, level=0):
+        """
+        Helper function to compute the pixel window covering bounds.
+        :param mapname: the name of the map
+        :param bounds: (left, bottom, right, top)
+        :param crs: crs of the bounds, None for the crs of the map
+        :param layer: the name of the layer
+        :param level: overview level, 0 for the full resolution
+        :return: rasterio Window in pixels of the level
+        """
+        transform = self._get_geo_transform(mapname, layer)
+        if crs is not None:
+            bounds = transform_bounds(bounds, crs, self._get_geo_crs(mapname, layer))
+        return bounds_to_window(bounds, transform * affine.Affine.scale(2 ** level))
+
+    def get_window(self, mapname, window, layer='map', level=0, crs=None):
+        """
+        Returns a window of the map or a layer, any area outside of the image is filled with 0.
+        The window is either a rasterio Window in pixels, or bounds (left, bottom, right, top)
+        that are converted to pixels using the stored transform, rounded outwards to whole
+        pixels. Bounds in another crs are transformed to the crs of the map first.
+        With memmap, a window inside an uncompressed contiguous image is a read-only view.
+        :param mapname: the name of the map
+        :param window: rasterio Window (col_off, row_off, width, height) in pixels of the level,
+                       or bounds (left, bottom, right, top)
+        :param layer: the name of the layer, defaults to the map
+        :param level: overview level, 0 for the full resolution
+        :param crs: crs of the bounds, None for the crs of the map
+        :return: window of the image as numpy array
+        """
+        if not isinstance(window, rasterio.windows.Window):
+            window = self._bounds_to_window(mapname, window, crs, layer, level)
+        image = self._get_memmap(mapname, layer, level)
+        if image is None:
+            image = self._get_dataset(mapname, layer, level)
+        return self._read_window(image, int(window.row_off), int(window.col_off), int(window.height),
+                                 int(window.width))
+
+    def get_patches_in_bounds(self, mapname, bounds, crs=None, layer=None):
+        """
+        Returns the patches of a map whose tile (the patch without its border) intersects bounds.
+        :param mapname: the name of the map
+        :param bounds: (left, bottom, right, top)
+        :param crs: crs of the bounds, None for the crs of the map
+        :param layer: only return patches with data for this layer, None for all patches
+        :return: list of [row, col] of the patches
+        """
+        transform = self._get_geo_transform(mapname, 'map')
+        if crs is not None:
+            bounds = transform_bounds(bounds, crs, self._get_geo_crs(mapname, 'map'))
+        patches = patches_in_bounds(bounds, transform, self.get_map_size(mapname), self.tile_size)
+        if layer is not None:
+            valid = {(int(row), int(col)) for row, col in self.get_patches_for_layer(mapname, layer)}
+            patches = [patch for patch in patches if tuple(patch) in valid]
+        return patches
+
+    def get_cache_stats(self):
+        """
+        Returns the statistics of the cache of decoded patches.
+        :return: dict with hits, misses, evictions, patches and bytes, None if there is no cache
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get_stats()
 
     # get patch by index
     # row and col are 0 based
-    def get_patch(self, row, col, mapname, layer="map"):
+    def get_patch(self, row, col, mapname, layer="map", level=0):
         """
-        Returns the cropped image of the patch.
+        Returns the cropped image of the patch. With a level the patch is cropped from the
+        overview level, using the same patch size and border, so a patch covers an area
+        2^level times larger of the map.
         :param row: the row of the patch
         :param col: the column of the patch
         :param mapname: the name of the map
         :param layer: the name of the layer
+        :param level: overview level, 0 for the full resolution
         :return: cropped image of patch as a numpy array
         """
         if row < 0 or col < 0:
             raise Exception("Invalid index")
-        return self._crop_image(self.h5f[mapname][layer], row, col)
+        if level == 0 and self._is_empty_patch(mapname, layer, row, col):
+            return np.zeros((self.patch_size, self.patch_size), dtype=np.uint8)
+        return self._read_patch(mapname, layer, row, col, level=level)
+
+    def get_patches_batch(self, locations, mapname=None, layer="map", out=None):
+        """
+        Returns the cropped images of many patches as a single numpy array. The locations
+        are either (row, col), using the mapname and layer given, or (mapname, layer, row, col).
+        All patches need to have the same number of bands. The patches are read grouped by
+        dataset and sorted by chunk, so patches sharing a chunk are read after each other.
+        :param locations: list of (row, col) or (mapname, layer, row, col)
+        :param mapname: the name of the map, used for (row, col) locations
+        :param layer: the name of the layer, used for (row, col) locations
+        :param out: numpy array (N, patch_size, patch_size[, 3]) to write the patches into
+        :return: patches as a numpy array (N, patch_size, patch_size[, 3])
+        """
+        patches = []
+        for location in locations:
+            if len(location) == 2:
+                if mapname is None:
+                    raise ValueError("Need mapname for (row, col) locations")
+                location = (mapname, layer, location[0], location[1])
+            if location[2] < 0 or location[3] < 0:
+                raise Exception("Invalid index")
+            patches.append(location)
+
+        # compute the shape of the result
+        shapes = {self.h5f[m][l].ndim for m, l in {(p[0], p[1]) for p in patches}}
+        if len(shapes) > 1:
+            raise ValueError("Can not mix images with different number of bands")
+        shape = (len(patches), self.patch_size, self.patch_size)
+        if shapes == {3}:
+            shape = shape + (3,)
+        if out is None:
+            out = np.zeros(shape, dtype=np.uint8)
+        elif out.shape != shape or out.dtype != np.uint8:
+            raise ValueError(f"Invalid output array, expected {shape} uint8, got {out.shape} {out.dtype}")
+
+        # sort patches by dataset and chunk
+        def chunk_key(i):
+            m, l, row, col = patches[i]
+            chunks = self.h5f[m][l].chunks or (1, 1)
+            x = max(0, row * self.tile_size - self.patch_border) // chunks[0]
+            y = max(0, col * self.tile_size - self.patch_border) // chunks[1]
+            return m, l, x, y, row, col
+        for i in sorted(range(len(patches)), key=chunk_key):
+            m, l, row, col = patches[i]
+            if self._is_empty_patch(m, l, row, col):
+                out[i] = 0
+            else:
+                self._read_patch(m, l, row, col, out=out[i])
+        return out
+
+    def get_patch_stack(self, row, col, mapname, layers=None, include_map=False):
+        """
+        Returns the cropped images of many layers of the same patch as a single numpy array.
+        Layers that have no data in the patch, according to the patch index, are not read
+        and are left as zeros.
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :param mapname: the name of the map
+        :param layers: list of layer names, if None all layers of the map are used
+        :param include_map: if True also return the patch of the map
+        :return: patches as a numpy array (L, patch_size, patch_size), if include_map a tuple
+                 with the patch of the map and the patches of the layers
+        """
+        if row < 0 or col < 0:
+            raise Exception("Invalid index")
+        if layers is None:
+            layers = self.get_layers(mapname)
+        found = set(self.get_layers_for_patch(mapname, row, col))
+        stack = np.zeros((len(layers), self.patch_size, self.patch_size), dtype=np.uint8)
+        for i, layer in enumerate(layers):
+            if layer in found:
+                self._read_patch(mapname, layer, row, col, out=stack[i])
+        if include_map:
+            return self.get_patch(row, col, mapname), stack
+        return stack
@@ -0,0 +1,270 @@
+import collections
+import multiprocessing
+import queue
+import time
+import weakref
+
+import numpy as np
+
+from .h5sampler import PatchSampler
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+
+def _worker(source, names, shapes, tasks, ready):
+    """
+    Helper function running in the worker processes. Each task is a slot and the patch to
+    read, the patches are written into the slot of the ring buffers, and the slot is sent back
+    when done, with the exception if the patch could not be read.
+    :param source: H5Image or H5Folder to read the patches from
+    :param names: names of the shared memory of the layers and maps (None if not used)
+    :param shapes: shapes of the ring buffers of the layers and maps
+    :param tasks: queue with (slot, mapname, layer, row, col), None to stop
+    :param ready: queue to send (slot, exception) when a slot is written
+    """
+    memories = [shared_memory.SharedMemory(name=name) if name else None for name in names]
+    layers, maps = [np.ndarray(shape, dtype=np.uint8, buffer=memory.buf) if memory else None
+                    for memory, shape in zip(memories, shapes)]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, mapname, layer, row, col = task
+            try:
+                layers[slot] = source.get_patch(row, col, mapname, layer)
+                if maps is not None:
+                    patch = source.get_patch(row, col, mapname)
+                    maps[slot] = patch if patch.ndim == 3 else patch[:, :, np.newaxis]
+                ready.put((slot, None))
+            except Exception as e:
+                ready.put((slot, e))
+    finally:
+        del layers, maps
+        for memory in memories:
+            if memory:
+                memory.close()
+        source.close()
+
+
+def _cleanup(processes, memories):
+    """
+    Helper function to stop the worker processes and free the shared memory, called by close,
+    or when the PatchLoader is garbage collected or the interpreter exits without close.
+    :param processes: worker processes, stopped if they are still running
+    :param memories: shared memory of the ring buffers
+    """
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    processes.clear()
+    for memory in memories:
+        if memory:
+            try:
+                memory.close()
+            except BufferError:
+                # arrays of samples still use the memory, it is unmapped when they are freed
+                pass
+            memory.unlink()
+    memories.clear()
+
+
+class PatchLoader:
+    """Iterator returning random patches read by worker processes into a shared memory ring buffer"""
+
+    def __init__(self, source, weights="uniform", seed=None, workers=4, slots=64, samples=None,
+                 include_map=True, channels=3, auto_release=True, context=None, timeout=1.0):
+        """
+        Create a new PatchLoader. The samples are picked the same way as PatchSampler, and read
+        by worker processes, that write the patches directly into a ring buffer of slots in
+        shared memory. Only the slot numbers are sent between the processes, the patches are not
+        pickled or copied. The samples are returned in the order they are picked, the arrays of
+        a sample are views of the ring buffer, and are valid until the slot is released, by
+        calling release, or when the next sample is requested if auto_release is set. When all
+        slots are in use, no new patches are read until a slot is released.
+        The legends are not part of the samples, since their size is different for every layer,
+        use get_legend of the source to read them.
+        The PatchLoader can be used as a context manager, that calls close at the end. The shared
+        memory is also freed if the PatchLoader is garbage collected without calling close.
+        :param source: H5Image or H5Folder to read the patches from, it is pickled and opened in
+                       every worker process
+        :param weights: weights of the samples, "uniform", "layer" or "coverage", see PatchSampler
+        :param seed: seed of the random generator, None for a random seed
+        :param workers: number of worker processes
+        :param slots: number of slots in the ring buffer
+        :param samples: number of samples returned by each iteration, None for no limit
+        :param include_map: read the patch of the map
+        :param channels: number of channels of the map patches
+        :param auto_release: release the slot of a sample when the next sample is requested
+        :param context: multiprocessing start method, None for the default
+        :param timeout: seconds to wait for a sample before checking the workers are alive
+        """
+        if shared_memory is None:
+            raise ImportError("PatchLoader needs multiprocessing.shared_memory (python 3.8 or newer)")
+        self.source = source
+        self.workers = workers
+        self.slots = slots
+        self.samples = samples
+        self.include_map = include_map
+        self.auto_release = auto_release
+        self.timeout = timeout
+        self._sampler = PatchSampler(source, weights=weights, seed=seed, include_map=False, include_legend=False)
+        patch_size = source.patch_size
+        self.patch_size = patch_size
+        self._shapes = [(slots, patch_size, patch_size), (slots, patch_size, patch_size, channels)]
+        self._memories = [shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+                          for shape in (self._shapes if include_map else self._shapes[:1])]
+        if not include_map:
+            self._memories.append(None)
+        self.layers, self.maps = [np.ndarray(shape, dtype=np.uint8, buffer=memory.buf) if memory else None
+                                  for memory, shape in zip(self._memories, self._shapes)]
+        self._free = collections.deque(range(slots))
+        self._held = set()
+        self._context = multiprocessing.get_context(context)
+        self._tasks = None
+        self._ready = None
+        self._processes = []
+        self._finalizer = weakref.finalize(self, _cleanup, self._processes, self._memories)
+        self._count = 0
+        self._elapsed = 0.0
+        self._waiting = 0.0
+
+    def __str__(self):
+        """
+        String representation of the object
+        :return: string representation
+        """
+        return f"PatchLoader(workers={self.workers}, slots={self.slots}, patch_size={self.patch_size}, " \
+               f"#free={len(self._free)})"
+
+    def _start(self):
+        """
+        Helper function to start the worker processes.
+        """
+        self._tasks = self._context.Queue()
+        self._ready = self._context.Queue()
+        names = [memory.name if memory else None for memory in self._memories]
+        for _ in range(self.workers):
+            process = self._context.Process(target=_worker, daemon=True,
+                                            args=(self.source, names, self._shapes, self._tasks, self._ready))
+            process.start()
+            self._processes.append(process)
+
+    def _wait(self):
+        """
+        Helper function to wait for the next slot written by the workers.
+        :return: slot and exception raised by the worker (None if the slot was written)
+        """
+        while True:
+            try:
+                return self._ready.get(timeout=self.timeout)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    raise RuntimeError("Worker process of PatchLoader stopped")
+
+    def release(self, sample):
+        """
+        Release the slot of a sample, so it can be used for a new patch. The arrays of the sample
+        should not be used after this.
+        :param sample: sample returned by the iterator, or the slot number
+        """
+        slot = sample["slot"] if isinstance(sample, dict) else sample
+        if slot in self._held:
+            self._held.remove(slot)
+            self._free.append(slot)
+
+    def __iter__(self):
+        """
+        Returns the samples, in the order they are picked.
+        :return: iterator of dicts with mapname, layername, row, col, slot, layer and map
+        """
+        if not self._processes:
+            self._start()
+        pending = collections.deque()
+        done = {}
+        picked = 0
+        last = time.perf_counter()
+        previous = None
+        try:
+            while True:
+                if previous is not None and self.auto_release:
+                    self.release(previous)
+                    previous = None
+                while self._free and (self.samples is None or picked < self.samples):
+                    slot = self._free.popleft()
+                    task = (slot,) + self._sampler._pick()
+                    self._tasks.put(task)
+                    pending.append(task)
+                    picked += 1
+                if not pending:
+                    if self.samples is None or picked < self.samples:
+                        raise RuntimeError("All slots of PatchLoader are held, release samples to continue")
+                    return
+                t = time.perf_counter()
+                slot, mapname, layer, row, col = pending[0]
+                while slot not in done:
+                    written, error = self._wait()
+                    done[written] = error
+                pending.popleft()
+                error = done.pop(slot)
+                now = time.perf_counter()
+                self._waiting += now - t
+                self._elapsed += now - last
+                last = now
+                self._held.add(slot)
+                if error is not None:
+                    self.release(slot)
+                    raise error
+                self._count += 1
+                previous = slot
+                sample = {"mapname": mapname, "layername": layer, "row": row, "col": col, "slot": slot,
+                          "layer": self.layers[slot]}
+                if self.maps is not None:
+                    sample["map"] = self.maps[slot]
+                yield sample
+        finally:
+            if previous is not None and self.auto_release:
+                self.release(previous)
+            # slots of samples still being read are free once they are written
+            for slot, *_ in pending:
+                while slot not in done:
+                    written, error = self._wait()
+                    done[written] = error
+            self._free.extend(done)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker processes and free the shared memory. The arrays of the samples should not
+        be used after this.
+        """
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join()
+        self.layers = self.maps = None
+        self._finalizer()
+
+    def get_stats(self):
+        """
+        Returns the number of samples returned, the time it took to return them and the time
+        spent waiting for the worker processes. If the waiting time is a large part of the time,
+        reading the samples is slower than the code using them.
+        :return: dict with samples, seconds, waiting and samples_per_sec
+        """
+        return {
+            'samples': self._count,
+            'seconds': self._elapsed,
+            'waiting': self._waiting,
+            'samples_per_sec': self._count / self._elapsed if self._elapsed > 0 else None,
+        }
@@ -0,0 +1,181 @@
+import collections
+import concurrent.futures
+import time
+
+import numpy as np
+
+from .h5image import patches_by_location
+
+
+class PatchSampler:
+    """Iterator returning random patches of a HDF5 file or folder, read ahead by worker threads"""
+
+    def __init__(self, source, weights="uniform", seed=None, workers=4, prefetch=16, samples=None,
+                 include_map=True, include_legend=True):
+        """
+        Create a new PatchSampler. Every sample is a patch of a layer of a map, and is picked
+        from a table of all patches with data for each layer, computed once from the patch
+        index. For a H5Folder with a catalog the table is computed from the catalog, without
+        opening the files, except for the coverage weights. The weights of the samples are:
+        - "uniform" : every valid patch has the same weight, split over the layers in the patch
+        - "layer" : every layer has the same weight, split over the patches of the layer, so
+                    layers with few patches are picked as often as layers with many patches
+        - "coverage" : every patch of a layer has a weight equal to the fraction of the patch
+                       where the layer has data (see H5Image.get_patch_coverage), for files
+                       without coverage every patch of a layer has the same weight
+        The samples are picked from a random generator using the seed, so the same seed gives
+        the same samples. The patches are read by worker threads, at most prefetch samples are
+        read ahead of the sample returned.
+        :param source: H5Image or H5Folder to read the patches from
+        :param weights: weights of the samples, "uniform", "layer" or "coverage"
+        :param seed: seed of the random generator, None for a random seed
+        :param workers: number of threads used to read the samples
+        :param prefetch: number of samples to read ahead
+        :param samples: number of samples returned by each iteration, None for no limit
+        :param include_map: read the patch of the map
+        :param include_legend: read the legend of the layer
+        """
+        if weights not in ("uniform", "layer", "coverage"):
+            raise ValueError(f"Unknown weights {weights}")
+        self.source = source
+        self.weights = weights
+        self.workers = workers
+        self.prefetch = max(1, prefetch)
+        self.samples = samples
+        self.include_map = include_map
+        self.include_legend = include_legend
+        self._rng = np.random.default_rng(seed)
+        self._executor = None
+        self._count = 0
+        self._elapsed = 0.0
+        self._waiting = 0.0
+        self._build_tables()
+
+    def __str__(self):
+        """
+        String representation of the object
+        :return: string representation
+        """
+        return f"PatchSampler(weights={self.weights}, #maps={len(self.maps)}, #layers={len(self.layers)}, " \
+               f"#items={len(self._cumulative)})"
+
+    def _build_tables(self):
+        """
+        Helper function to compute the table of all (map, layer, row, col) that can be sampled
+        and the cumulative weights of the table.
+        """
+        self.maps = []
+        self.layers = []
+        layer_ids = {}
+        items = []
+        weights = []
+        for m, mapname in enumerate(self.source.get_maps()):
+            self.maps.append(mapname)
+            patches = self.source.get_patches(mapname)
+            layers_patch = patches_by_location(patches)
+            for layer, locations in patches.items():
+                if layer not in layer_ids:
+                    layer_ids[layer] = len(self.layers)
+                    self.layers.append(layer)
+                coverage = None
+                if self.weights == "coverage":
+                    try:
+                        coverage = self.source.get_patch_coverage(mapname, layer)
+                    except ValueError:
+                        pass
+                for row, col in locations:
+                    items.append((m, layer_ids[layer], row, col))
+                    if self.weights == "uniform":
+                        weights.append(1.0 / len(layers_patch[f"{row}_{col}"]))
+                    elif self.weights == "layer":
+                        weights.append(1.0 / len(locations))
+                    elif coverage is not None:
+                        weights.append(coverage[row, col])
+                    else:
+                        weights.append(1.0)
+        if not items:
+            raise ValueError("No patches to sample")
+        self._items = np.array(items, dtype=np.int32)
+        weights = np.array(weights, dtype=np.float64)
+        if self.weights == "layer":
+            # same weight for every layer, over all maps
+            totals = np.bincount(self._items[:, 1], weights=weights)
+            weights = weights / totals[self._items[:, 1]]
+        self._cumulative = np.cumsum(weights)
+
+    def _pick(self):
+        """
+        Helper function to pick the next sample.
+        :return: (mapname, layer, row, col)
+        """
+        i = np.searchsorted(self._cumulative, self._rng.random() * self._cumulative[-1], side='right')
+        m, layer, row, col = self._items[min(i, len(self._items) - 1)]
+        return self.maps[m], self.layers[layer], int(row), int(col)
+
+    def _read(self, mapname, layer, row, col):
+        """
+        Helper function to read a sample, called in the worker threads.
+        :param mapname: the name of the map
+        :param layer: the name of the layer
+        :param row: the row of the patch
+        :param col: the column of the patch
+        :return: dict with the sample
+        """
+        sample = {"mapname": mapname, "layername": layer, "row": row, "col": col,
+                  "layer": self.source.get_patch(row, col, mapname, layer)}
+        if self.include_map:
+            sample["map"] = self.source.get_patch(row, col, mapname)
+        if self.include_legend:
+            sample["legend"] = self.source.get_legend(mapname, layer)
+        return sample
+
+    def __iter__(self):
+        """
+        Returns the samples, in the order they are picked.
+        :return: iterator of dicts with mapname, layername, row, col, layer, map and legend
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        pending = collections.deque()
+        picked = 0
+        last = time.perf_counter()
+        try:
+            while True:
+                while len(pending) < self.prefetch and (self.samples is None or picked < self.samples):
+                    pending.append(self._executor.submit(self._read, *self._pick()))
+                    picked += 1
+                if not pending:
+                    return
+                t = time.perf_counter()
+                sample = pending.popleft().result()
+                now = time.perf_counter()
+                self._waiting += now - t
+                self._elapsed += now - last
+                last = now
+                self._count += 1
+                yield sample
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """
+        Stop the worker threads
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def get_stats(self):
+        """
+        Returns the number of samples returned, the time it took to return them and the time
+        spent waiting for the worker threads. If the waiting time is a large part of the time,
+        reading the samples is slower than the code using them.
+        :return: dict with samples, seconds, waiting and samples_per_sec
+        """
+        return {
+            'samples': self._count,
+            'seconds': self._elapsed,
+            'waiting': self._waiting,
+            'samples_per_sec': self._count / self._elapsed if self._elapsed > 0 else None,
+        }
@@ -0,0 +1,301 @@
+import argparse
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import logging
+import os
+import os.path
+import pathlib
+import socketserver
+import struct
+import threading
+import urllib.parse
+import zlib
+
+import numpy as np
+
+from .h5cache import PatchCache
+from .h5catalog import open_h5image
+from .h5folder import H5Folder
+
+
+def encode_png(image, level=6):
+    """
+    Encode an image as PNG, using only zlib. Images with 3 bands are encoded as RGB, other
+    images as grayscale. Layers with only the values 0 and 1 are scaled to 0 and 255, so
+    they can be seen.
+    :param image: image as numpy array (uint8)
+    :param level: zlib compression level
+    :return: PNG as bytes
+    """
+    if image.ndim == 3 and image.shape[2] == 3:
+        color = 2
+    else:
+        color = 0
+        image = image.reshape(image.shape[:2])
+        if image.max(initial=0) <= 1:
+            image = image * np.uint8(255)
+    height, width = image.shape[:2]
+    if height == 0 or width == 0:
+        raise ValueError("Can not encode an empty image")
+    data = image.reshape(height, -1)
+    # every row starts with the filter type, 0 is no filter
+    rows = np.zeros((height, 1 + data.shape[1]), dtype=np.uint8)
+    rows[:, 1:] = data
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) + \
+        chunk(b'IEND', b'')
+
+
+class TileServer:
+    """Encodes patches and legends of a HDF5 file or folder as PNG tiles, with a cache of encoded tiles"""
+
+    def __init__(self, source, cache_bytes=256 * 2**20, workers=4, prefetch=0):
+        """
+        Create a new TileServer. The tiles are read and encoded in a pool of workers threads, at
+        most cache_bytes of encoded tiles are kept in a LRU cache. The ETag of a tile is computed
+        from the file (path, size and modification time) and the dataset of the tile, so a tile
+        that is not modified can be answered without reading the file. If prefetch is set, the
+        tiles around a requested tile (up to prefetch rows and columns away) are encoded in the
+        background and stored in the cache.
+        :param source: H5Image or H5Folder to serve
+        :param cache_bytes: size of the cache of encoded tiles in bytes, 0 to disable the cache
+        :param workers: number of threads used to read and encode tiles
+        :param prefetch: number of rows and columns around a tile to encode in the background
+        """
+        self.source = source
+        self.prefetch = prefetch
+        self.cache = PatchCache(cache_bytes) if cache_bytes > 0 else None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        """
+        String representation of the object
+        :return: string representation
+        """
+        return f"TileServer(source={self.source}, cache={self.cache}, prefetch={self.prefetch})"
+
+    def close(self):
+        """
+        Stop the worker threads and close the file or folder.
+        """
+        self._executor.shutdown()
+        self.source.close()
+
+    def _get_filename(self, mapname):
+        """
+        Helper function to get the HDF5 file with the map.
+        :param mapname: the name of the map
+        :return: filename of the HDF5 file
+        """
+        if isinstance(self.source, H5Folder):
+            return self.source.get_filename(mapname)
+        if mapname not in self.source.h5f:
+            raise KeyError(f"Map not found: {mapname}")
+        return self.source.h5file
+
+    def get_etag(self, key):
+        """
+        Returns the ETag of a tile, computed from the file and the tile, without reading any data.
+        :param key: key of the tile, (mapname, layer, row, col, level) or (mapname, layer, 'legend')
+        :return: ETag as quoted string
+        """
+        filename = self._get_filename(key[0])
+        stat = os.stat(filename)
+        identity = json.dumps([os.path.realpath(filename), stat.st_size, stat.st_mtime_ns] + list(key))
+        return '"' + hashlib.sha1(identity.encode('utf-8')).hexdigest() + '"'
+
+    def _encode(self, key):
+        """
+        Helper function to read and encode a tile, running in a worker thread.
+        :param key: key of the tile, see get_etag
+        :return: PNG as numpy array of bytes
+        """
+        if key[2] == 'legend':
+            image = self.source.get_legend(key[0], key[1])
+        else:
+            mapname, layer, row, col, level = key
+            image = self.source.get_patch(row, col, mapname, layer, level)
+        if image is None:
+            raise ValueError(f"Invalid tile {key}")
+        png = np.frombuffer(encode_png(np.asarray(image)), dtype=np.uint8)
+        if self.cache is not None:
+            self.cache.put(key, png)
+        return png
+
+    def _submit(self, key):
+        """
+        Helper function to encode a tile in the worker threads, if the tile is already being
+        encoded the same future is returned.
+        :param key: key of the tile, see get_etag
+        :return: future with the PNG
+        """
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._executor.submit(self._encode, key)
+                self._pending[key] = future
+                future.add_done_callback(lambda _: self._forget(key))
+            return future
+
+    def _forget(self, key):
+        """
+        Helper function to remove a tile that is encoded from the pending tiles.
+        :param key: key of the tile
+        """
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def get_tile(self, key):
+        """
+        Returns the encoded tile, from the cache if possible.
+        :param key: key of the tile, see get_etag
+        :return: PNG as numpy array of bytes
+        """
+        png = self.cache.get(key) if self.cache is not None else None
+        if png is None:
+            png = self._submit(key).result()
+        if self.prefetch and self.cache is not None and key[2] != 'legend':
+            mapname, layer, row, col, level = key
+            for r in range(max(0, row - self.prefetch), row + self.prefetch + 1):
+                for c in range(max(0, col - self.prefetch), col + self.prefetch + 1):
+                    other = (mapname, layer, r, c, level)
+                    if other != key and other not in self.cache:
+                        self._submit(other)
+        return png
+
+    def get_info(self, mapname=None):
+        """
+        Returns the maps served, or the size and layers of a map.
+        :param mapname: the name of the map, None for the list of maps
+        :return: dict with the maps and cache statistics, or the size and layers of the map
+        """
+        if mapname is None:
+            return {'maps': self.source.get_maps(),
+                    'cache': self.cache.get_stats() if self.cache is not None else None}
+        self._get_filename(mapname)
+        return {'map': mapname,
+                'size': list(self.source.get_map_size(mapname)),
+                'layers': self.source.get_layers(mapname),
+                'overviews': self.source.get_overview_levels(mapname)}
+
+
+class _TileHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server answering every request in its own thread"""
+    daemon_threads = True
+
+
+class _TileHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the requests of h5serve, the TileServer is the tiles attribute of the server"""
+
+    def do_GET(self):
+        """
+        Answer a request for:
+        - / : list of maps
+        - /{map} : size, layers and overview levels of the map
+        - /{map}/{layer}/{row}/{col}.png : patch of the layer (use map for the map), ?level=k for overviews
+        - /{map}/{layer}/legend.png : legend of the layer
+        """
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.split('/') if part]
+        tiles = self.server.tiles
+        try:
+            if len(parts) <= 1:
+                self._send(200, 'application/json', json.dumps(tiles.get_info(*parts)).encode('utf-8'))
+                return
+            if len(parts) == 3 and parts[2] == 'legend.png':
+                key = (parts[0], parts[1], 'legend')
+            elif len(parts) == 4 and parts[3].endswith('.png'):
+                query = urllib.parse.parse_qs(url.query)
+                row, col = int(parts[2]), int(parts[3][:-4])
+                level = int(query.get('level', ['0'])[0])
+                if row < 0 or col < 0 or level < 0:
+                    raise ValueError(f"Invalid tile {row}, {col}, level {level}")
+                key = (parts[0], parts[1], row, col, level)
+            else:
+                self._send(404, 'text/plain', b'Not found')
+                return
+            etag = tiles.get_etag(key)
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self._send(304, None, b'', etag)
+                return
+            self._send(200, 'image/png', tiles.get_tile(key), etag)
+        except KeyError as e:
+            self._send(404, 'text/plain', f"Not found: {e}".encode('utf-8'))
+        except ValueError as e:
+            self._send(400, 'text/plain', f"Bad request: {e}".encode('utf-8'))
+        except Exception as e:
+            logging.exception(f"Error serving {self.path}")
+            self._send(500, 'text/plain', f"Error: {e}".encode('utf-8'))
+
+    def _send(self, status, content_type, body, etag=None):
+        """
+        Helper function to send a response.
+        :param status: HTTP status code
+        :param content_type: content type of the body, None for no body
+        :param body: body as bytes (or numpy array of bytes)
+        :param etag: ETag of the body
+        """
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        if content_type:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if content_type:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def serve(path, host="127.0.0.1", port=8000, cache_bytes=256 * 2**20, workers=4, prefetch=0):
+    """
+    Serve the patches and legends of a HDF5 file, or of all HDF5 files in a folder, as PNG
+    tiles over HTTP, until interrupted.
+    :param path: HDF5 file or folder
+    :param host: address to listen on
+    :param port: port to listen on
+    :param cache_bytes: size of the cache of encoded tiles in bytes
+    :param workers: number of threads used to read and encode tiles
+    :param prefetch: number of rows and columns around a tile to encode in the background
+    """
+    source = H5Folder(path) if os.path.isdir(path) else open_h5image(path)
+    server = _TileHTTPServer((host, port), _TileHandler)
+    server.tiles = TileServer(source, cache_bytes, workers, prefetch)
+    print(f"Serving {path} on http://{host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.tiles.close()
+
+
+def h5serve():
+    parser = argparse.ArgumentParser(description='Serve patches and legends of HDF5 files as PNG tiles.')
+    parser.add_argument('path', type=pathlib.Path,
+                        help='HDF5 file or folder with HDF5 files')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on (default: 8000)')
+    parser.add_argument('--cache-mb', type=int, default=256,
+                        help='size of the cache of encoded tiles in MB (default: 256)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of threads to read and encode tiles (default: 4)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='rows and columns around a tile to encode in the background (default: 0)')
+    args = parser.parse_args()
+    serve(str(args.path), args.host, args.port, args.cache_mb * 2**20, args.workers, args.prefetch)
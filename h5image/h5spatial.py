@@ -0,0 +1,143 @@
+import math
+
+import affine
+import numpy as np
+import rasterio.crs
+import rasterio.transform
+import rasterio.warp
+import rasterio.windows
+
+# crs of the footprints used to find maps in any crs
+LONLAT = "EPSG:4326"
+
+# pixels are rounded to the nearest pixel if they are this close, to ignore rounding errors
+_EPSILON = 1e-6
+
+
+def transform_bounds(bounds, src_crs, dst_crs):
+    """
+    Transform bounds from one crs to another.
+    :param bounds: (left, bottom, right, top) in src_crs
+    :param src_crs: crs of the bounds, a rasterio CRS, a string or EPSG code
+    :param dst_crs: crs to transform the bounds to
+    :return: (left, bottom, right, top) in dst_crs
+    """
+    src_crs = rasterio.crs.CRS.from_user_input(src_crs)
+    dst_crs = rasterio.crs.CRS.from_user_input(dst_crs)
+    if src_crs == dst_crs:
+        return tuple(bounds)
+    return rasterio.warp.transform_bounds(src_crs, dst_crs, *bounds)
+
+
+def bounds_to_window(bounds, transform):
+    """
+    Compute the pixel window covering bounds, rounded outwards to whole pixels.
+    :param bounds: (left, bottom, right, top) in the crs of the transform
+    :param transform: affine transform of the image
+    :return: rasterio Window, can be partly or completely outside of the image
+    """
+    window = rasterio.windows.from_bounds(*bounds, transform=transform)
+    row1 = math.floor(window.row_off + _EPSILON)
+    col1 = math.floor(window.col_off + _EPSILON)
+    row2 = math.ceil(window.row_off + window.height - _EPSILON)
+    col2 = math.ceil(window.col_off + window.width - _EPSILON)
+    return rasterio.windows.Window(col1, row1, max(0, col2 - col1), max(0, row2 - row1))
+
+
+def patches_in_bounds(bounds, transform, shape, tile_size):
+    """
+    Compute the patches of an image that intersect bounds. A patch covers the tile of the
+    patch, without the border.
+    :param bounds: (left, bottom, right, top) in the crs of the transform
+    :param transform: affine transform of the image
+    :param shape: shape of the image
+    :param tile_size: size of the tiles of the patches
+    :return: list of [row, col] of the patches
+    """
+    window = bounds_to_window(bounds, transform)
+    rows = math.ceil(shape[0] / tile_size)
+    cols = math.ceil(shape[1] / tile_size)
+    row1 = max(0, window.row_off // tile_size)
+    col1 = max(0, window.col_off // tile_size)
+    row2 = min(rows, -(-(window.row_off + window.height) // tile_size))
+    col2 = min(cols, -(-(window.col_off + window.width) // tile_size))
+    return [[row, col] for row in range(row1, row2) for col in range(col1, col2)]
+
+
+def map_footprint(crs, transform, shape):
+    """
+    Compute the footprint of a map, stored in the catalog and used by the spatial index.
+    :param crs: crs of the map, None if not known
+    :param transform: affine transform of the map, None if not known
+    :param shape: shape of the map
+    :return: dict with crs (string), transform (6 numbers), bounds (left, bottom, right, top)
+             and lonlat (bounds in EPSG:4326), None for the values that are not known
+    """
+    footprint = {'crs': crs.to_string() if crs else None, 'transform': None, 'bounds': None, 'lonlat': None}
+    if transform is None:
+        return footprint
+    footprint['transform'] = list(transform)[:6]
+    left, bottom, right, top = rasterio.transform.array_bounds(shape[0], shape[1], transform)
+    footprint['bounds'] = [min(left, right), min(bottom, top), max(left, right), max(bottom, top)]
+    if crs:
+        footprint['lonlat'] = list(transform_bounds(footprint['bounds'], crs, LONLAT))
+    return footprint
+
+
+def bounds_intersect(bounds, other):
+    """
+    Check if two bounds intersect, bounds that only touch intersect.
+    :param bounds: (left, bottom, right, top)
+    :param other: (left, bottom, right, top)
+    :return: True if the bounds intersect
+    """
+    return bounds[0] <= other[2] and bounds[2] >= other[0] and bounds[1] <= other[3] and bounds[3] >= other[1]
+
+
+def footprint_transform(footprint):
+    """
+    Returns the affine transform of a footprint.
+    :param footprint: footprint of a map, see map_footprint
+    :return: affine transform, None if not known
+    """
+    if not footprint.get('transform'):
+        return None
+    return affine.Affine(*footprint['transform'])
+
+
+class SpatialIndex:
+    """Index of the bounds of maps, using an R-tree if the rtree package is installed"""
+
+    def __init__(self, bounds):
+        """
+        Create a new SpatialIndex.
+        :param bounds: dict with for each name the bounds (left, bottom, right, top)
+        """
+        self.names = list(bounds.keys())
+        self.bounds = np.array([bounds[name] for name in self.names], dtype=np.float64).reshape(-1, 4)
+        try:
+            import rtree
+            self._rtree = rtree.index.Index((i, tuple(b), None) for i, b in enumerate(self.bounds)) \
+                if self.names else None
+        except ImportError:
+            self._rtree = None
+
+    def __str__(self):
+        """
+        String representation of the object
+        :return: string representation
+        """
+        return f"SpatialIndex(#maps={len(self.names)}, rtree={self._rtree is not None})"
+
+    def intersection(self, bounds):
+        """
+        Returns the names of the entries that intersect the bounds.
+        :param bounds: (left, bottom, right, top)
+        :return: list of names, in the order they were added
+        """
+        if self._rtree is not None:
+            return [self.names[i] for i in sorted(self._rtree.intersection(tuple(bounds)))]
+        left, bottom, right, top = bounds
+        found = (self.bounds[:, 0] <= right) & (self.bounds[:, 2] >= left) & \
+                (self.bounds[:, 1] <= top) & (self.bounds[:, 3] >= bottom)
+        return [self.names[i] for i in np.flatnonzero(found)]
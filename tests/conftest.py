@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+
+def write_map(folder, name="TEST_Map", height=300, width=410, layers=4, seed=0, layer_sizes=None,
+              origin=(-120.0, 40.0)):
+    """
+    Write a synthetic map (json, rgb tif and one tif per layer) as read by H5Image.add_image.
+    The layers have a few random rectangles, the last layer only has the corner pixels set.
+    :param folder: folder to write the files to
+    :param name: name of the map
+    :param height: height of the map
+    :param width: width of the map
+    :param layers: number of layers
+    :param seed: seed of the random generator
+    :param layer_sizes: list with the (height, width) of each layer, None for the size of the map
+    :param origin: (lon, lat) of the top left corner of the map, pixels are 0.001 degrees
+    :return: dict with the map and layers as numpy arrays
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    profile = dict(driver='GTiff', height=height, width=width, dtype='uint8', crs='EPSG:4326',
+                   transform=from_origin(origin[0], origin[1], 0.001, 0.001))
+    images = {'map': rng.integers(0, 255, (height, width, 3), dtype=np.uint8)}
+    with rasterio.open(os.path.join(folder, f"{name}.tif"), 'w', count=3, **profile) as dst:
+        dst.write(images['map'].transpose(2, 0, 1))
+    shapes = []
+    for i in range(layers):
+        label = f"L{i}_poly"
+        rows, cols = layer_sizes[i] if layer_sizes else (height, width)
+        mask = np.zeros((rows, cols), np.uint8)
+        if i == layers - 1:
+            mask[0, 0] = mask[-1, -1] = 1
+        else:
+            for _ in range(rng.integers(1, 4)):
+                row, col = rng.integers(0, rows), rng.integers(0, cols)
+                mask[row:row + rng.integers(1, 80), col:col + rng.integers(1, 80)] = 1
+        images[label] = mask
+        layer_profile = dict(profile, height=rows, width=cols)
+        with rasterio.open(os.path.join(folder, f"{name}_{label}.tif"), 'w', count=1, **layer_profile) as dst:
+            dst.write(mask[np.newaxis])
+        shapes.append({"label": label, "points": [[10, 10], [40, 30]]})
+    with open(os.path.join(folder, f"{name}.json"), "w") as f:
+        json.dump({"shapes": shapes}, f)
+    return images
+
+
+@pytest.fixture
+def map_folder(tmp_path):
+    """
+    Folder with a synthetic map, see write_map.
+    :return: folder and dict with the map and layers as numpy arrays
+    """
+    folder = str(tmp_path / "data")
+    return folder, write_map(folder)
@@ -0,0 +1,152 @@
+import asyncio
+import concurrent.futures
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from h5image import AsyncH5Image, H5Folder, H5Image, PatchSampler, build_catalog, load_catalog, save_catalog
+
+from conftest import write_map
+
+MAPS = 6
+
+
+@pytest.fixture(scope="module")
+def folder(tmp_path_factory):
+    """
+    Folder with one HDF5 file per map, named after the map.
+    """
+    tmp_path = tmp_path_factory.mktemp("folder")
+    hdf = tmp_path / "hdf"
+    hdf.mkdir()
+    for i in range(MAPS):
+        name = f"MAP{i}"
+        write_map(str(tmp_path / "data"), name=name, height=150, width=200, layers=2, seed=i)
+        h5i = H5Image(str(hdf / f"{name}.hdf5"), "w", patch_size=64, patch_border=4)
+        h5i.add_image(f"{name}.json", str(tmp_path / "data"))
+        h5i.close()
+    return str(hdf)
+
+
+def _expected(folder):
+    expected = {}
+    for filename in sorted(os.listdir(folder)):
+        mapname = os.path.splitext(filename)[0]
+        h5i = H5Image(os.path.join(folder, filename), "r", patch_size=64, patch_border=4)
+        for row, col in h5i.get_valid_patches(mapname):
+            for layer in ["map"] + h5i.get_layers(mapname):
+                expected[(mapname, layer, row, col)] = h5i.get_patch(row, col, mapname, layer)
+        h5i.close()
+    return expected
+
+
+def test_threads_with_few_open_files(folder):
+    expected = _expected(folder)
+    h5f = H5Folder(folder, max_open_files=1)
+    keys = list(expected.keys()) * 4
+    np.random.default_rng(0).shuffle(keys)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        patches = list(executor.map(lambda key: h5f.get_patch(key[2], key[3], key[0], key[1]), keys))
+    for key, patch in zip(keys, patches):
+        np.testing.assert_array_equal(patch, expected[key])
+    assert len(h5f._images) <= 1
+    assert not h5f._leases and not h5f._evicted
+    h5f.close()
+
+
+def test_sampler_with_few_open_files(folder):
+    expected = _expected(folder)
+    sampler = PatchSampler(H5Folder(folder, max_open_files=1), seed=1, workers=8, samples=100,
+                           include_legend=False)
+    count = 0
+    for sample in sampler:
+        key = (sample["mapname"], sample["layername"], sample["row"], sample["col"])
+        np.testing.assert_array_equal(sample["layer"], expected[key])
+        count += 1
+    sampler.close()
+    assert count == 100
+
+
+def test_async_with_few_open_files(folder):
+    expected = _expected(folder)
+
+    async def read_all():
+        async with AsyncH5Image(H5Folder(folder, max_open_files=1), workers=8) as reader:
+            return await asyncio.gather(*[reader.get_patch(row, col, mapname, layer)
+                                          for mapname, layer, row, col in expected.keys()])
+
+    for key, patch in zip(expected.keys(), asyncio.run(read_all())):
+        np.testing.assert_array_equal(patch, expected[key])
+
+
+def test_empty_batch(folder):
+    h5f = H5Folder(folder)
+    h5i = H5Image(os.path.join(folder, "MAP0.hdf5"), "r", patch_size=64, patch_border=4)
+    assert h5f.patch_size == 64
+    assert h5f.get_patches_batch([]).shape == h5i.get_patches_batch([]).shape == (0, 64, 64)
+    assert not h5f._images
+
+    async def read_empty():
+        async with AsyncH5Image(h5f) as reader:
+            return await reader.get_patches_batch([])
+
+    assert asyncio.run(read_empty()).shape == (0, 64, 64)
+    h5i.close()
+
+
+@pytest.fixture
+def catalog_folder(folder, tmp_path):
+    """
+    Copy of the folder with a catalog.
+    """
+    copy = str(tmp_path / "catalog")
+    shutil.copytree(folder, copy)
+    build_catalog(copy)
+    return copy
+
+
+@pytest.mark.parametrize("weights", ["uniform", "layer"])
+def test_sampler_tables_from_catalog(folder, catalog_folder, weights):
+    h5f = H5Folder(catalog_folder)
+    sampler = PatchSampler(h5f, weights=weights, seed=1, samples=10)
+    assert not h5f._images
+    expected = PatchSampler(H5Folder(folder), weights=weights, seed=1, samples=10)
+    assert sampler.maps == expected.maps and sampler.layers == expected.layers
+    np.testing.assert_array_equal(sampler._items, expected._items)
+    np.testing.assert_allclose(sampler._cumulative, expected._cumulative)
+    for mapname in expected.maps:
+        h5i = H5Image(os.path.join(folder, f"{mapname}.hdf5"), "r", patch_size=64, patch_border=4)
+        assert h5f.get_patches(mapname) == h5i.get_patches(mapname)
+        assert h5f.get_patches(mapname, by_location=True) == h5i.get_patches(mapname, by_location=True)
+        h5i.close()
+    assert not h5f._images
+    for sample, other in zip(sampler, expected):
+        np.testing.assert_array_equal(sample["layer"], other["layer"])
+    sampler.close()
+    expected.close()
+    h5f.close()
+
+
+def test_catalog_without_patches_is_rebuilt(catalog_folder):
+    maps = load_catalog(catalog_folder)
+    for entry in maps.values():
+        del entry["patches"]
+    save_catalog(catalog_folder, maps)
+    h5f = H5Folder(catalog_folder)
+    assert h5f.get_patches("MAP0")
+    assert list(h5f._images) == ["MAP0"]
+    h5f.close()
+    assert all("patches" in entry for entry in build_catalog(catalog_folder).values())
+
+
+def test_all_valid_patches_from_catalog(folder, catalog_folder):
+    h5f = H5Folder(catalog_folder)
+    patches = h5f.get_all_valid_patches()
+    assert not h5f._images
+    expected = H5Folder(folder, catalog=None)
+    assert patches == expected.get_all_valid_patches()
+    assert patches
+    expected.close()
+    h5f.close()
@@ -0,0 +1,157 @@
+import copy
+import json
+
+import numpy as np
+import pytest
+from rasterio.windows import Window
+
+from h5image import H5Image
+
+from conftest import write_map
+
+
+@pytest.fixture
+def h5image(map_folder, tmp_path):
+    folder, _ = map_folder
+    h5i = H5Image(str(tmp_path / "test.hdf5"), "w", patch_size=64, patch_border=4)
+    h5i.add_image("TEST_Map.json", folder)
+    yield h5i
+    h5i.close()
+
+
+def test_patches_are_copies(h5image):
+    patches = h5image.get_patches("TEST_Map")
+    by_location = h5image.get_patches("TEST_Map", by_location=True)
+    valid_patches = h5image.get_valid_patches("TEST_Map")
+    expected = copy.deepcopy((patches, by_location, valid_patches))
+    assert patches and by_location and valid_patches
+
+    next(iter(patches.values())).clear()
+    patches.clear()
+    next(iter(by_location.values())).append("modified")
+    by_location.clear()
+    valid_patches[0].append(-1)
+    valid_patches.clear()
+
+    assert h5image.get_patches("TEST_Map") == expected[0]
+    assert h5image.get_patches("TEST_Map", by_location=True) == expected[1]
+    assert h5image.get_valid_patches("TEST_Map") == expected[2]
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_chunk_layouts_read_the_same(map_folder, tmp_path, sparse):
+    folder, _ = map_folder
+    images = {}
+    for chunks in ["patch", "tile"]:
+        h5i = H5Image(str(tmp_path / f"{chunks}.hdf5"), "w", patch_size=64, patch_border=4, chunks=chunks,
+                      sparse=sparse)
+        h5i.add_image("TEST_Map.json", folder)
+        images[chunks] = h5i
+    assert images["patch"].h5f["TEST_Map"]["map"].chunks == (64, 64, 3)
+    assert images["tile"].h5f["TEST_Map"]["map"].chunks == (56, 56, 3)
+    for loc, layers in images["patch"].get_patches("TEST_Map", by_location=True).items():
+        row, col = [int(v) for v in loc.split("_")]
+        for layer in ["map"] + layers:
+            np.testing.assert_array_equal(images["patch"].get_patch(row, col, "TEST_Map", layer),
+                                          images["tile"].get_patch(row, col, "TEST_Map", layer))
+    for h5i in images.values():
+        h5i.close()
+
+
+def test_layers_with_other_size(tmp_path):
+    folder = str(tmp_path / "data")
+    write_map(folder, height=300, width=410, layers=3, layer_sizes=[(260, 370), (340, 450), (340, 450)])
+    h5i = H5Image(str(tmp_path / "test.hdf5"), "w", patch_size=64, patch_border=4)
+    h5i.add_image("TEST_Map.json", folder)
+    assert h5i.get_layers("TEST_Map") == ["L0_poly", "L1_poly", "L2_poly"]
+    index = h5i.h5f["TEST_Map"]["_index"]
+    assert index["cells"].shape == (3, 10, 13)
+    assert index["coverage"].shape == (3, 6, 8)
+    h5i.close()
+
+
+def test_add_layer_without_patch_index_updates_index(map_folder, tmp_path):
+    folder, _ = map_folder
+    filename = str(tmp_path / "test.hdf5")
+    h5i = H5Image(filename, "w", patch_size=64, patch_border=4)
+    h5i.add_image("TEST_Map.json", folder)
+    h5i.close()
+    write_map(str(tmp_path / "extra"), layers=2, seed=5)
+
+    h5i = H5Image(filename, "a", patch_index=False)
+    h5i.add_layer("TEST_Map", "extra", str(tmp_path / "extra" / "TEST_Map_L0_poly.tif"))
+    assert "extra" in h5i.h5f["TEST_Map"]["_index"]["layers"].asstr()[...]
+    patches = h5i.get_patches("TEST_Map")
+    assert patches["extra"] == json.loads(h5i.h5f["TEST_Map"]["extra"].attrs["patches"])
+    assert patches["extra"]
+    for row, col in patches["extra"]:
+        assert "extra" in h5i.get_layers_for_patch("TEST_Map", row, col)
+        stack = h5i.get_patch_stack(row, col, "TEST_Map", ["extra"])
+        np.testing.assert_array_equal(stack[0], h5i.get_patch(row, col, "TEST_Map", "extra"))
+        assert stack[0].any()
+    h5i.close()
+
+
+@pytest.mark.parametrize("max_window_bytes", [None, 64 * 1024])
+def test_overviews_of_contiguous_images(map_folder, tmp_path, max_window_bytes):
+    folder, _ = map_folder
+    images = {}
+    for name, args in [("chunked", {}), ("contiguous", dict(chunks=None, compression=None))]:
+        h5i = H5Image(str(tmp_path / f"{name}.hdf5"), "w", patch_size=64, patch_border=4, overviews=2,
+                      max_window_bytes=max_window_bytes, **args)
+        h5i.add_image("TEST_Map.json", folder)
+        images[name] = h5i
+    assert images["contiguous"].h5f["TEST_Map"]["map"].chunks is None
+    for level in (1, 2):
+        assert images["contiguous"].get_map_size("TEST_Map", level) == images["chunked"].get_map_size("TEST_Map", level)
+        for layer in ["map"] + images["chunked"].get_layers("TEST_Map"):
+            for row, col in [(0, 0), (1, 2)]:
+                np.testing.assert_array_equal(images["contiguous"].get_patch(row, col, "TEST_Map", layer, level),
+                                              images["chunked"].get_patch(row, col, "TEST_Map", layer, level))
+    for h5i in images.values():
+        h5i.close()
+
+
+def _all_patches(h5i, mapname):
+    rows, cols = [-(-size // h5i.tile_size) for size in h5i.get_map_size(mapname)[:2]]
+    return [(row, col) for row in range(rows + 1) for col in range(cols + 1)]
+
+
+def test_packed_masks_read_the_same(map_folder, tmp_path):
+    folder, images = map_folder
+    h5i = H5Image(str(tmp_path / "plain.hdf5"), "w", patch_size=64, patch_border=4)
+    h5i.add_image("TEST_Map.json", folder)
+    packed = H5Image(str(tmp_path / "packed.hdf5"), "w", patch_size=64, patch_border=4, pack_masks=True)
+    packed.add_image("TEST_Map.json", folder)
+    assert packed.h5f["TEST_Map"]["L0_poly"].shape == (300, 52)
+    assert packed.get_patches("TEST_Map") == h5i.get_patches("TEST_Map")
+    for layer in packed.get_layers("TEST_Map"):
+        np.testing.assert_array_equal(packed.get_layer("TEST_Map", layer), images[layer])
+        for row, col in _all_patches(h5i, "TEST_Map"):
+            np.testing.assert_array_equal(packed.get_patch(row, col, "TEST_Map", layer),
+                                          h5i.get_patch(row, col, "TEST_Map", layer))
+    h5i.close()
+    packed.close()
+
+
+def test_memmap_reads_the_same(map_folder, tmp_path):
+    folder, _ = map_folder
+    h5i = H5Image(str(tmp_path / "chunked.hdf5"), "w", patch_size=64, patch_border=4)
+    h5i.add_image("TEST_Map.json", folder)
+    contiguous = H5Image(str(tmp_path / "contiguous.hdf5"), "w", patch_size=64, patch_border=4, chunks=None,
+                         compression=None)
+    contiguous.add_image("TEST_Map.json", folder)
+    contiguous.close()
+    mapped = H5Image(str(tmp_path / "contiguous.hdf5"), "r", memmap=True)
+    assert mapped._get_memmap("TEST_Map", "map") is not None
+    for layer in ["map"] + mapped.get_layers("TEST_Map"):
+        for row, col in _all_patches(h5i, "TEST_Map"):
+            np.testing.assert_array_equal(mapped.get_patch(row, col, "TEST_Map", layer),
+                                          h5i.get_patch(row, col, "TEST_Map", layer))
+        for window in [Window(10, 20, 100, 50), Window(-30, 250, 100, 100), Window(400, 0, 64, 64)]:
+            np.testing.assert_array_equal(mapped.get_window("TEST_Map", window, layer),
+                                          h5i.get_window("TEST_Map", window, layer))
+    view = mapped.get_window("TEST_Map", Window(10, 20, 100, 50))
+    assert not view.flags.writeable
+    h5i.close()
+    mapped.close()
@@ -0,0 +1,62 @@
+import gc
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from h5image import H5Folder, H5Image, PatchLoader
+
+
+@pytest.fixture
+def h5file(map_folder, tmp_path):
+    folder, _ = map_folder
+    filename = str(tmp_path / "TEST_Map.hdf5")
+    h5i = H5Image(filename, "w", patch_size=64, patch_border=4)
+    h5i.add_image("TEST_Map.json", folder)
+    h5i.close()
+    return filename
+
+
+def _exists(name):
+    try:
+        shared_memory.SharedMemory(name=name).close()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def test_samples(h5file):
+    h5i = H5Image(h5file, "r")
+    with PatchLoader(h5i, seed=1, workers=2, slots=4, samples=20) as loader:
+        assert loader.patch_size == 64
+        for sample in loader:
+            expected = h5i.get_patch(sample["row"], sample["col"], "TEST_Map", sample["layername"])
+            np.testing.assert_array_equal(sample["layer"], expected)
+    h5i.close()
+
+
+def test_patch_size_without_reading(h5file, tmp_path):
+    h5f = H5Folder(str(tmp_path))
+    loader = PatchLoader(h5f, seed=1, workers=1, slots=2, samples=1, include_map=False)
+    assert loader.patch_size == h5f.patch_size == 64
+    loader.close()
+
+
+def test_memory_freed_on_exception(h5file):
+    with pytest.raises(RuntimeError):
+        with PatchLoader(H5Image(h5file, "r"), seed=1, workers=2, slots=4) as loader:
+            names = [memory.name for memory in loader._memories if memory]
+            for _ in loader:
+                raise RuntimeError("training failed")
+    assert not any(_exists(name) for name in names)
+
+
+def test_memory_freed_without_close(h5file):
+    loader = PatchLoader(H5Image(h5file, "r"), seed=1, workers=2, slots=4, samples=5)
+    names = [memory.name for memory in loader._memories if memory]
+    assert all(_exists(name) for name in names)
+    for _ in loader:
+        pass
+    del loader
+    gc.collect()
+    assert not any(_exists(name) for name in names)
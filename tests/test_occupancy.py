@@ -0,0 +1,117 @@
+import json
+import math
+import os
+
+import numpy as np
+import pytest
+
+from h5image import H5Image
+
+from conftest import write_map
+
+SIZES = [(256, 3), (100, 20), (64, 0), (37, 5), (50, 24)]
+
+
+def _old_crop_image(image, x, y, patch_size, patch_border):
+    """
+    Crop of a patch as done by the old _crop_image, the area outside of the image is 0.
+    """
+    tile_size = patch_size - 2 * patch_border
+    dst_x1 = dst_y1 = 0
+    src_x1 = (x * tile_size) - patch_border
+    if src_x1 < 0:
+        dst_x1 = -src_x1
+        src_x1 = 0
+    src_x2 = min((x * tile_size) + tile_size + patch_border, image.shape[0])
+    src_y1 = (y * tile_size) - patch_border
+    if src_y1 < 0:
+        dst_y1 = -src_y1
+        src_y1 = 0
+    src_y2 = min((y * tile_size) + tile_size + patch_border, image.shape[1])
+    rgb = np.zeros((patch_size, patch_size) + image.shape[2:], dtype=image.dtype)
+    if src_x2 <= src_x1 or src_y2 <= src_y1:
+        # patch outside of a layer smaller than the map, the old code failed to crop these
+        return rgb
+    rgb[dst_x1:dst_x1 + src_x2 - src_x1, dst_y1:dst_y1 + src_y2 - src_y1] = image[src_x1:src_x2, src_y1:src_y2]
+    return rgb
+
+
+def _old_occupancy(layers, shape, patch_size, patch_border):
+    """
+    Patches, layers_patch, valid_patches and corners as computed by the old loop over all patches.
+    """
+    tile_size = patch_size - 2 * patch_border
+    w = math.ceil(shape[0] / tile_size)
+    h = math.ceil(shape[1] / tile_size)
+    all_patches = {}
+    layers_patch = {}
+    for label, image in layers.items():
+        patches = []
+        for x in range(w):
+            for y in range(h):
+                rgb = _old_crop_image(image, x, y, patch_size, patch_border)
+                if np.average(rgb, axis=(0, 1)) > 0:
+                    patches.append((x, y))
+                    layers_patch.setdefault(f"{x}_{y}", []).append(label)
+        all_patches[label] = patches
+    valid_patches = [[int(k.split('_')[0]), int(k.split('_')[1])] for k in layers_patch.keys()]
+    r1 = min(v[0] for v in valid_patches)
+    r2 = max(v[0] for v in valid_patches)
+    c1 = min(v[1] for v in valid_patches)
+    c2 = max(v[1] for v in valid_patches)
+    # round trip through json, as stored in the file
+    return json.loads(json.dumps({'patches': all_patches, 'layers_patch': layers_patch,
+                                  'valid_patches': valid_patches, 'corners': [[r1, c1], [r2, c2]]}))
+
+
+def _stored_occupancy(h5i, mapname):
+    attrs = h5i.h5f[mapname].attrs
+    return {'patches': json.loads(attrs['patches']),
+            'layers_patch': json.loads(attrs['layers_patch']),
+            'valid_patches': json.loads(attrs['valid_patches']),
+            'corners': np.asarray(attrs['corners']).tolist()}
+
+
+@pytest.mark.parametrize("max_window_bytes", [None, 64 * 1024])
+@pytest.mark.parametrize("patch_size,patch_border", SIZES)
+def test_add_image_matches_old_loop(map_folder, tmp_path, patch_size, patch_border, max_window_bytes):
+    folder, images = map_folder
+    layers = {k: v for k, v in images.items() if k != 'map'}
+    h5i = H5Image(str(tmp_path / "test.hdf5"), "w", patch_size=patch_size, patch_border=patch_border,
+                  max_window_bytes=max_window_bytes)
+    h5i.add_image("TEST_Map.json", folder)
+    expected = _old_occupancy(layers, images['map'].shape, patch_size, patch_border)
+    assert _stored_occupancy(h5i, "TEST_Map") == expected
+    assert h5i.get_patches("TEST_Map") == expected['patches']
+    assert h5i.get_valid_patches("TEST_Map") == expected['valid_patches']
+    h5i.close()
+
+
+@pytest.mark.parametrize("patch_size,patch_border", SIZES)
+def test_add_layer_matches_old_loop(map_folder, tmp_path, patch_size, patch_border):
+    folder, images = map_folder
+    extra = write_map(str(tmp_path / "extra"), height=300, width=410, layers=1, seed=3)
+    layers = {k: v for k, v in images.items() if k != 'map'}
+    layers['extra'] = extra['L0_poly']
+    h5i = H5Image(str(tmp_path / "test.hdf5"), "w", patch_size=patch_size, patch_border=patch_border)
+    h5i.add_image("TEST_Map.json", folder)
+    h5i.add_layer("TEST_Map", "extra", os.path.join(str(tmp_path / "extra"), "TEST_Map_L0_poly.tif"))
+    expected = _old_occupancy(layers, images['map'].shape, patch_size, patch_border)
+    assert _stored_occupancy(h5i, "TEST_Map") == expected
+    h5i.close()
+
+
+@pytest.mark.parametrize("max_window_bytes", [None, 64 * 1024])
+@pytest.mark.parametrize("patch_size,patch_border", SIZES)
+def test_layers_with_other_size_match_old_loop(tmp_path, patch_size, patch_border, max_window_bytes):
+    folder = str(tmp_path / "data")
+    images = write_map(folder, height=300, width=410, layers=4,
+                       layer_sizes=[(340, 450), (260, 370), (340, 450), (340, 450)])
+    layers = {k: v for k, v in images.items() if k != 'map'}
+    h5i = H5Image(str(tmp_path / "test.hdf5"), "w", patch_size=patch_size, patch_border=patch_border,
+                  max_window_bytes=max_window_bytes)
+    h5i.add_image("TEST_Map.json", folder)
+    expected = _old_occupancy(layers, images['map'].shape, patch_size, patch_border)
+    assert _stored_occupancy(h5i, "TEST_Map") == expected
+    assert h5i.get_patches("TEST_Map") == expected['patches']
+    h5i.close()
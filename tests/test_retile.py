@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from h5image import H5Image
+
+
+@pytest.fixture
+def stored(map_folder, tmp_path):
+    """
+    File written with a patch size and border different from the ones used to read it.
+    """
+    folder, _ = map_folder
+    filename = str(tmp_path / "stored.hdf5")
+    h5i = H5Image(filename, "w", patch_size=64, patch_border=0)
+    h5i.add_image("TEST_Map.json", folder)
+    h5i.close()
+    return filename
+
+
+def _native(folder, tmp_path, patch_size, patch_border):
+    h5i = H5Image(str(tmp_path / f"native_{patch_size}_{patch_border}.hdf5"), "w", patch_size=patch_size,
+                  patch_border=patch_border)
+    h5i.add_image("TEST_Map.json", folder)
+    return h5i
+
+
+def _as_sets(patches):
+    return {layer: {tuple(p) for p in values} for layer, values in patches.items()}
+
+
+def test_retile_exact_for_multiples_of_cells(map_folder, tmp_path, stored):
+    # tile size 64 and border 32 are multiples of the 32 pixel cells
+    native = _native(map_folder[0], tmp_path, 128, 32)
+    retiled = H5Image(stored, "r", patch_size=128, patch_border=32, retile=True)
+    assert _as_sets(retiled.get_patches("TEST_Map")) == _as_sets(native.get_patches("TEST_Map"))
+    assert retiled.get_valid_patches("TEST_Map") == native.get_valid_patches("TEST_Map")
+    assert retiled.get_map_corners("TEST_Map")[0].tolist() == list(native.get_map_corners("TEST_Map")[0])
+    assert retiled.get_map_corners("TEST_Map")[1].tolist() == list(native.get_map_corners("TEST_Map")[1])
+    for layer in native.get_layers("TEST_Map"):
+        np.testing.assert_array_equal(retiled.get_patch_coverage("TEST_Map", layer),
+                                      native.get_patch_coverage("TEST_Map", layer))
+        for row, col in native.get_patches_for_layer("TEST_Map", layer):
+            np.testing.assert_array_equal(retiled.get_patch(row, col, "TEST_Map", layer),
+                                          native.get_patch(row, col, "TEST_Map", layer))
+    retiled.close()
+    native.close()
+
+
+def test_retile_superset_otherwise(map_folder, tmp_path, stored):
+    # tile size 80 and border 10 are not multiples of the cells, no patch with data is missed
+    native = _native(map_folder[0], tmp_path, 100, 10)
+    retiled = H5Image(stored, "r", patch_size=100, patch_border=10, retile=True)
+    native_patches = _as_sets(native.get_patches("TEST_Map"))
+    retiled_patches = _as_sets(retiled.get_patches("TEST_Map"))
+    assert native_patches.keys() == retiled_patches.keys()
+    for layer, patches in native_patches.items():
+        assert patches <= retiled_patches[layer]
+        for row, col in retiled_patches[layer] - patches:
+            # extra patches have no data
+            assert not retiled.get_patch(row, col, "TEST_Map", layer).any()
+        for row, col in patches:
+            np.testing.assert_array_equal(retiled.get_patch(row, col, "TEST_Map", layer),
+                                          native.get_patch(row, col, "TEST_Map", layer))
+        assert (retiled.get_patch_coverage("TEST_Map", layer) >= native.get_patch_coverage("TEST_Map", layer)).all()
+    retiled.close()
+    native.close()
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from h5image import H5Folder, H5Image, build_catalog
+from h5image.h5spatial import transform_bounds
+
+from conftest import write_map
+
+# pixels 100..200 of the columns and 150..200 of the rows of a map written by write_map
+BOUNDS = (-119.9, 39.8, -119.8, 39.85)
+
+
+@pytest.fixture
+def h5image(map_folder, tmp_path):
+    folder, _ = map_folder
+    h5i = H5Image(str(tmp_path / "test.hdf5"), "w", patch_size=64, patch_border=4)
+    h5i.add_image("TEST_Map.json", folder)
+    yield h5i
+    h5i.close()
+
+
+def test_bounds(h5image):
+    np.testing.assert_allclose(h5image.get_bounds("TEST_Map"), (-120.0, 39.7, -119.59, 40.0))
+    left, bottom, right, top = h5image.get_bounds("TEST_Map", crs="EPSG:3857")
+    assert left < right and bottom < top
+    np.testing.assert_allclose(transform_bounds((left, bottom, right, top), "EPSG:3857", "EPSG:4326"),
+                               (-120.0, 39.7, -119.59, 40.0))
+
+
+@pytest.mark.parametrize("layer", ["map", "L0_poly"])
+def test_window_from_bounds(map_folder, h5image, layer):
+    _, images = map_folder
+    expected = images[layer][150:200, 100:200]
+    np.testing.assert_array_equal(h5image.get_window("TEST_Map", BOUNDS, layer), expected)
+    mercator = transform_bounds(BOUNDS, "EPSG:4326", "EPSG:3857")
+    np.testing.assert_array_equal(h5image.get_window("TEST_Map", mercator, layer, crs="EPSG:3857"), expected)
+
+
+def test_window_from_bounds_outside_map(map_folder, h5image):
+    _, images = map_folder
+    window = h5image.get_window("TEST_Map", (-120.01, 39.99, -119.99, 40.01))
+    assert window.shape == (20, 20, 3)
+    assert not window[:10].any() and not window[:, :10].any()
+    np.testing.assert_array_equal(window[10:, 10:], images["map"][:10, :10])
+
+
+def test_patches_in_bounds(h5image):
+    # tiles of 56 pixels, columns 100..200 are in tiles 1..3, rows 150..200 in tiles 2..3
+    expected = [[row, col] for row in [2, 3] for col in [1, 2, 3]]
+    assert h5image.get_patches_in_bounds("TEST_Map", BOUNDS) == expected
+    mercator = transform_bounds(BOUNDS, "EPSG:4326", "EPSG:3857")
+    assert h5image.get_patches_in_bounds("TEST_Map", mercator, crs="EPSG:3857") == expected
+    valid = {tuple(patch) for patch in h5image.get_patches_for_layer("TEST_Map", "L0_poly")}
+    assert h5image.get_patches_in_bounds("TEST_Map", BOUNDS, layer="L0_poly") == \
+        [patch for patch in expected if tuple(patch) in valid]
+    assert h5image.get_patches_in_bounds("TEST_Map", (0, 0, 1, 1)) == []
+
+
+@pytest.fixture
+def folder(tmp_path):
+    """
+    Folder with a catalog of three maps of 0.2 by 0.15 degrees next to each other, 0.5 degrees apart.
+    """
+    hdf = tmp_path / "hdf"
+    hdf.mkdir()
+    for i in range(3):
+        name = f"MAP{i}"
+        write_map(str(tmp_path / "data"), name=name, height=150, width=200, layers=2, seed=i,
+                  origin=(-120.0 + 0.5 * i, 40.0))
+        h5i = H5Image(str(hdf / f"{name}.hdf5"), "w", patch_size=64, patch_border=4)
+        h5i.add_image(f"{name}.json", str(tmp_path / "data"))
+        h5i.close()
+    build_catalog(str(hdf))
+    return str(hdf)
+
+
+def test_folder_maps_in_bounds(folder):
+    h5f = H5Folder(folder)
+    assert h5f.get_maps_in_bounds((-119.45, 39.9, -119.35, 39.95)) == ["MAP1"]
+    assert h5f.get_maps_in_bounds((-120.5, 39.0, -118.5, 41.0)) == ["MAP0", "MAP1", "MAP2"]
+    assert h5f.get_maps_in_bounds((-110.0, 39.0, -109.0, 41.0)) == []
+    mercator = transform_bounds((-119.4, 39.9, -118.9, 39.95), "EPSG:4326", "EPSG:3857")
+    assert h5f.get_maps_in_bounds(mercator, crs="EPSG:3857") == ["MAP1", "MAP2"]
+    np.testing.assert_allclose(h5f.get_bounds("MAP2"), (-119.0, 39.85, -118.8, 40.0))
+    assert not h5f._images
+    h5f.close()
+
+
+def test_folder_patches_in_bounds(folder):
+    h5f = H5Folder(folder)
+    bounds = (-119.85, 39.9, -119.4, 39.95)
+    patches = h5f.get_patches_in_bounds(bounds)
+    assert not h5f._images
+    assert list(patches.keys()) == ["MAP0", "MAP1"]
+    for mapname, expected in patches.items():
+        h5i = H5Image(h5f.get_filename(mapname), "r")
+        assert h5i.get_patches_in_bounds(mapname, bounds) == expected
+        assert h5f.get_patches_in_bounds(bounds, layer="L0_poly").get(mapname, []) == \
+            h5i.get_patches_in_bounds(mapname, bounds, layer="L0_poly")
+        h5i.close()
+    h5f.close()